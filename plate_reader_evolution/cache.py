@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+
+import os
+import time
+import pickle
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+from .parse import parse_plate_design
+
+
+logger = logging.getLogger('evol.cache')
+
+# part of every cache key: bump it whenever the parsers or the stored
+# format change, so that entries written by older versions are not reused
+CACHE_VERSION = 3
+
+
+def default_cache_dir():
+    '''Location of the on-disk cache
+
+    Can be changed through the PRE_CACHE_DIR environment variable
+    '''
+    return os.environ.get('PRE_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'),
+                                       '.cache', 'plate_reader_evolution'))
+
+
+def file_digest(infile, chunk_size=1 << 20):
+    '''SHA-256 of a file's content'''
+    h = hashlib.sha256()
+    with open(infile, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _plate_fname(cache_dir, digest, kind, p384=False):
+    geometry = '384' if p384 else '96'
+    return os.path.join(cache_dir, 'plates',
+                        f'v{CACHE_VERSION}_{digest}_{kind}_{geometry}.npz')
+
+
+def save_plate(fname, m):
+    '''Store a parsed plate as compact binary arrays
+
+    Accepts the output of either parse_excel (a Series)
+    or parse_excel_time_series (a DataFrame)
+    '''
+    arrays = {'row': m.index.get_level_values('row').values.astype('S'),
+              'column': m.index.get_level_values('column').values.astype(np.int16)}
+    if isinstance(m, pd.Series):
+        arrays['od600'] = m.values.astype(float)
+    else:
+        arrays['time'] = m['time'].values.astype(np.int64)
+        arrays['od600'] = m['od600'].values.astype(float)
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    # write then move, so that concurrent readers never see partial files
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, fname)
+
+
+def load_plate(fname):
+    '''Load a plate stored with save_plate'''
+    with np.load(fname) as a:
+        index = pd.MultiIndex.from_arrays([a['row'].astype(str),
+                                           a['column'].astype(np.int64)],
+                                          names=['row', 'column'])
+        if 'time' not in a:
+            return pd.Series(a['od600'], index=index, name='od600')
+        return pd.DataFrame({'time': a['time'],
+                             'od600': a['od600']},
+                            index=index)
+
+
+def cached_parse(infile, kinds, parse, cache_dir=None, p384=False):
+    '''Parse a plate reader file, reusing a previous result if available
+
+    Args:
+        infile (str)
+            Excel file to parse
+        kinds (iterable)
+            Parser kinds that could have produced a cached entry
+            (e.g. "endpoint", "timeseries")
+        parse (callable)
+            Called as parse(infile, p384) on a cache miss, must
+            return a (kind, parsed plate) tuple
+        cache_dir (str or None)
+            Cache location; if None the cache is bypassed
+        p384 (bool)
+            Whether the plate is a 384-well one
+
+    Returns:
+        kind (str)
+            Parser kind
+        m (pandas.Series or pandas.DataFrame)
+            Parsed plate
+    '''
+    if cache_dir is None:
+        return parse(infile, p384)
+
+    digest = file_digest(infile)
+    for kind in kinds:
+        fname = _plate_fname(cache_dir, digest, kind, p384)
+        if not os.path.exists(fname):
+            continue
+        try:
+            m = load_plate(fname)
+        except Exception as e:
+            logger.warning(f'could not read cached entry {fname} ({e})')
+            continue
+        # refresh the access time, used for eviction
+        os.utime(fname)
+        logger.debug(f'using cached {kind} parse of {infile}')
+        return kind, m
+
+    kind, m = parse(infile, p384)
+    try:
+        save_plate(_plate_fname(cache_dir, digest, kind, p384), m)
+    except OSError as e:
+        logger.warning(f'could not cache {infile} ({e})')
+
+    return kind, m
+
+
+def evict(cache_dir, max_size=None, max_age=None):
+    '''Remove stale entries from the cache
+
+    Args:
+        cache_dir (str)
+            Cache location
+        max_size (float or None)
+            Maximum cache size (MB); least recently used entries are
+            removed first
+        max_age (float or None)
+            Maximum age (days) since an entry was last used
+    '''
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for fname in files:
+            fname = os.path.join(root, fname)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, fname))
+    # oldest first
+    entries.sort()
+
+    now = time.time()
+    total = sum(x[1] for x in entries)
+    removed = 0
+    for used, size, fname in entries:
+        too_old = max_age is not None and now - used > max_age * 24 * 60 * 60
+        too_big = max_size is not None and total > max_size * 1024 * 1024
+        if not too_old and not too_big:
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    if removed:
+        logger.debug(f'evicted {removed} entries from {cache_dir}')
+
+
+def _design_fname(cache_dir, infile):
+    key = hashlib.sha256(os.path.abspath(infile).encode()).hexdigest()
+    return os.path.join(cache_dir, 'designs', f'v{CACHE_VERSION}_{key}.pkl')
+
+
+def _compile_plate_design(infile):
+    # every sheet is kept, in workbook order, so that the output
+    # matches parse_plate_design
+    sheets = {}
+    experiments = {}
+    for name, experiment, plate, m in parse_plate_design(infile):
+        sheets[name] = (experiment, plate,
+                        {k: m[k].values for k in m.columns})
+        experiments[experiment] = experiments.get(experiment, []) + [name]
+    return sheets, experiments
+
+
+def cached_plate_design(infile, cache_dir=None, experiment=None):
+    '''Access the plate designs through a compiled index
+
+    The index holds the design of each sheet as arrays, keyed by sheet
+    name, along with the sheets of each experiment, so that those can be
+    looked up directly; it is stored in the cache and only rebuilt when
+    the design file changes (modification time first, then content)
+
+    Args:
+        infile (str)
+            Excel file with the plate designs
+        cache_dir (str or None)
+            Cache location; if None the cache is bypassed
+        experiment (str or None)
+            Only return the designs of this experiment (default: all)
+
+    Returns a generator of (design string, experiment, plate, design dataframe),
+    like parse_plate_design
+    '''
+    if cache_dir is None:
+        for name, exp, plate, m in parse_plate_design(infile):
+            if experiment is None or exp == experiment:
+                yield name, exp, plate, m
+        return
+
+    fname = _design_fname(cache_dir, infile)
+    st = os.stat(infile)
+
+    index = None
+    if os.path.exists(fname):
+        try:
+            with open(fname, 'rb') as f:
+                index = pickle.load(f)
+        except Exception as e:
+            logger.warning(f'could not read compiled design {fname} ({e})')
+
+    if index is not None and (index['mtime'] != st.st_mtime or
+                              index['size'] != st.st_size):
+        # touched but maybe unchanged
+        digest = file_digest(infile)
+        if index['digest'] == digest:
+            index['mtime'] = st.st_mtime
+            index['size'] = st.st_size
+            _save_index(fname, index)
+        else:
+            index = None
+
+    if index is None:
+        logger.debug(f'compiling plate design {infile}')
+        index = {'mtime': st.st_mtime,
+                 'size': st.st_size,
+                 'digest': file_digest(infile),
+                 'sheets': _compile_plate_design(infile)}
+        try:
+            _save_index(fname, index)
+        except OSError as e:
+            logger.warning(f'could not cache {infile} ({e})')
+    else:
+        logger.debug(f'using compiled plate design for {infile}')
+        os.utime(fname)
+
+    sheets, experiments = index['sheets']
+    if experiment is None:
+        names = sheets.keys()
+    else:
+        names = experiments.get(experiment, [])
+    for name in names:
+        exp, plate, arrays = sheets[name]
+        yield name, exp, plate, pd.DataFrame(arrays)
+
+
+def _save_index(fname, index):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
@@ -2,6 +2,7 @@
 
 
 import os
+import sys
 import logging
 import argparse
 import numpy as np
@@ -9,8 +10,14 @@ import pandas as pd
 import logging.handlers
 
 from .__init__ import __version__
-from .grate import calc_growth_rate, grate_delta
+from .grate import rolling_growth_rate, top_growth_rate, grate_delta
+from .grate import derivative_growth_rate
+from .grate import growth_summaries, trim_wells, subtract_background
+from .grate import save_windows, load_windows
 from .plot import create_figure, plot_growth_rate
+from .tables import FORMATS, read_tables, iter_plates, write_table, compact
+from .growth import MODELS, fit_growth
+from .parallel import map_jobs, group_chunks
 from .colorlog import ColorFormatter
 
 
@@ -36,32 +43,129 @@ def get_options():
     parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('data',
-                        nargs='+',
-                        help='Input reading from plate reader; '
+                        nargs='*',
+                        help='Input reading from plate reader '
+                             '(tsv, parquet or feather format); '
                              'should contain the following columns: '
                              '"strain", "treatment", '
                              '"concentration", "plate", '
                              '"row", "column", '
                              '"experiment", "od600", "time"')
     parser.add_argument('output',
-                        help='Output file for growth rate (tsv format)')
+                        help='Output file for growth rate '
+                             '(tsv, parquet or feather format)')
+    parser.add_argument('--from-windows',
+                        default=None,
+                        help='Use the growth rate estimates saved with '
+                             '--windows-output instead of the readings '
+                             '(npz format, default: compute them)')
+    parser.add_argument('--windows-output',
+                        default=None,
+                        help='Save the growth rate estimates of all '
+                             'windows, to be reused with --from-windows '
+                             '(npz format, default: don\'t)')
+    parser.add_argument('--table-format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the output table '
+                             '(default: from the file extension, '
+                             'tsv if unknown)')
 
     parser.add_argument('--maximum-od',
                         type=float,
                         default=0.6,
-                        help='Maximum OD600 to consider '
+                        help='Maximum OD600 to consider, each well '
+                             'is trimmed at the first point reaching it '
                              '(default: %(default).2f)')
+    parser.add_argument('--maximum-time',
+                        type=float,
+                        default=None,
+                        help='Maximum time to consider, as for '
+                             '--maximum-od (hours, default: the whole curve)')
+    parser.add_argument('--background',
+                        choices=('none',
+                                 'mean',
+                                 'median',
+                                 'smooth'),
+                        default='none',
+                        help='Subtract the OD600 of blank wells '
+                             '(no strain or "Media Control") at each '
+                             'timepoint, using their mean, median or a '
+                             'running median over time '
+                             '(default: %(default)s)')
+    parser.add_argument('--background-window',
+                        type=int,
+                        default=5,
+                        help='Number of timepoints used to smooth the '
+                             'background (default: %(default)d)')
+    parser.add_argument('--method',
+                        choices=('rolling',
+                                 'derivative'),
+                        default='rolling',
+                        help='How to estimate growth rates: slope of '
+                             'ln(OD600) in rolling time windows, or '
+                             'derivative of ln(OD600) smoothed with a '
+                             'Savitzky-Golay filter '
+                             '(default: %(default)s)')
     parser.add_argument('--window',
                         type=int,
                         default=60,
-                        help='Time window to use '
+                        help='Time window to use with the rolling method '
                              '(minutes, default: %(default)d)')
+    parser.add_argument('--sg-window',
+                        type=int,
+                        default=7,
+                        help='Number of points of the Savitzky-Golay '
+                             'filter, odd (default: %(default)d)')
+    parser.add_argument('--sg-order',
+                        type=int,
+                        default=2,
+                        help='Polynomial order of the Savitzky-Golay '
+                             'filter (default: %(default)d)')
     parser.add_argument('--top-mu',
                         type=int,
                         default=4,
                         help='How many growth rate estimates '
                              'to keep to compute the average '
                              '(default: the top %(default)d estimates)')
+    parser.add_argument('--summaries',
+                        default=False,
+                        action='store_true',
+                        help='Also report area under the curve, '
+                             'maximum OD600, time to reach --od-threshold '
+                             'and doubling time for each well '
+                             '(default: doesn\'t)')
+    parser.add_argument('--od-threshold',
+                        type=float,
+                        default=0.3,
+                        help='OD600 threshold for the time to '
+                             'threshold summary (default: %(default).2f)')
+    parser.add_argument('--model',
+                        choices=sorted(MODELS),
+                        action='append',
+                        default=None,
+                        help='Also fit a parametric growth model to each '
+                             'well, reporting lag time, maximum growth '
+                             'rate and carrying capacity; can be '
+                             'repeated (default: none)')
+    parser.add_argument('--streaming',
+                        default=False,
+                        action='store_true',
+                        help='Read and process one plate at a time, '
+                             'to reduce memory usage; each plate should '
+                             'be in a single input file, with its rows '
+                             'grouped together in tsv files '
+                             '(default: all plates at once)')
+    parser.add_argument('--reference',
+                        default='ancestral',
+                        help='Treatment of the reference wells of each '
+                             'strain, used to compute growth rate deltas '
+                             '(default: %(default)s)')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to compute '
+                             'growth rates (default: %(default)d)')
 
     parser.add_argument('--plot',
                         default=False,
@@ -85,7 +189,25 @@ def get_options():
     parser.add_argument('--version', action='version',
                         version='%(prog)s '+__version__)
 
-    return parser.parse_args()
+    options = parser.parse_args()
+    if options.from_windows is None and len(options.data) == 0:
+        parser.error('either provide readings or use --from-windows')
+    if options.sg_window % 2 == 0 or options.sg_window <= options.sg_order:
+        parser.error('--sg-window should be odd and larger than --sg-order')
+
+    return options
+
+
+def _growth_rate(args):
+    df, groupby, method, kwargs = args
+    if method == 'derivative':
+        return derivative_growth_rate(df, groupby, **kwargs)
+    return rolling_growth_rate(df, groupby, **kwargs)
+
+
+def _fit_growth(args):
+    df, groupby, models = args
+    return fit_growth(df, groupby, models)
 
 
 def plot(v, params, outdir, fmt, fig):
@@ -97,94 +219,208 @@ def plot(v, params, outdir, fmt, fig):
     plot_growth_rate(v, p, fname, fig=fig, name=name)
 
 
-def main():
-    options = get_options()
-
-    set_logging(options.v)
-
-    df = []
-    for filename in options.data:
-        logger.info(f'reading data from {filename}')
-        df.append(pd.read_csv(filename, sep='\t'))
-    df = pd.concat(df)
-
-    # trim the data at the maximum OD
-    # TODO: trim using time
-    df = df[df['od600'] < options.maximum_od]
-
+def plot_windows(v, outdir, fmt, fig):
+    name = '_'.join([str(x) for x in v.name])
+    fname = os.path.join(outdir, f'{name}.{fmt}')
+    logger.info(f'plotting growth rate {name}')
+    logger.debug(f'creating file {fname}')
+    plot_growth_rate(None, v[['time', 'grate']], fname, fig=fig, name=name)
+
+
+def grate_wells(df, groupby, options):
+    '''Growth rate (and other descriptors) of a set of wells
+
+    Returns:
+        mu (pandas.DataFrame)
+            Growth rate of each well
+        extra (pandas.DataFrame or None)
+            Summaries and model fits of each well, if requested
+        mu_all (pandas.DataFrame)
+            Growth rate estimates in each window
+        df (pandas.DataFrame)
+            Trimmed growth curves
+    '''
     # seconds to hours
     df['time'] = df['time'] / 60 / 60
-    # create a timedelta index
-    # allows for rolling windows
-    df.index = pd.to_timedelta(df['time'], unit='h')
+
+    # ugly hack to allow groupby operations
+    df['concentration'] = df['concentration'].fillna(0)
+
+    if options.background != 'none':
+        logger.info(f'subtracting background ({options.background})')
+        df = subtract_background(df, method=options.background,
+                                 window=options.background_window)
+
+    # chunks of wells are processed together,
+    # a few chunks per job to balance the load
+    n_chunks = 1 if options.jobs <= 1 else options.jobs * 4
+
+    extra = []
+    if options.summaries:
+        logger.info('computing growth curve summaries for each well')
+        extra.append(growth_summaries(df, groupby,
+                                      threshold=options.od_threshold))
+
+    if options.model:
+        logger.info(f'fitting {", ".join(options.model)} '
+                    'growth models to each well')
+        # on the whole curves, so that the
+        # carrying capacity can be estimated
+        params = map_jobs(_fit_growth,
+                          [(x, groupby, options.model)
+                           for x in group_chunks(df, groupby, n_chunks)],
+                          jobs=options.jobs)
+        extra.append(pd.concat(list(params)))
+
+    # trim each well at its first point
+    # above the maximum OD (or time)
+    df = trim_wells(df, groupby,
+                    maximum_od=options.maximum_od,
+                    maximum_time=options.maximum_time).copy()
+
+    if options.background != 'none':
+        # no log for values below the background
+        df = df[df['od600'] > 0].copy()
 
     # take the natual log of OD600
     df['ln(od)'] = np.log(df['od600'])
 
-    # ugly hack to allow groupby operations
-    df['concentration'] = df['concentration'].fillna(0)
+    logger.info('computing growth rate for each well')
+
+    # calculate growth rate
+    # all windows of a chunk of wells at once
+    if options.method == 'derivative':
+        kwargs = {'window': options.sg_window,
+                  'order': options.sg_order}
+    else:
+        kwargs = {'window': f'{options.window}min'}
+    mu_all = map_jobs(_growth_rate,
+                      [(x, groupby, options.method, kwargs)
+                       for x in group_chunks(df, groupby, n_chunks)],
+                      jobs=options.jobs)
+    mu_all = pd.concat(list(mu_all), ignore_index=True)
+    # average of the top estimates,
+    # wells without any estimate are kept
+    wells = df.groupby(groupby, observed=True).size().index
+    mu = top_growth_rate(mu_all, groupby,
+                         top=options.top_mu).reindex(wells)
+
+    if options.summaries:
+        extra[0]['doubling_time'] = np.log(2) / mu.reindex(extra[0].index)
+    if len(extra) > 0:
+        extra = pd.concat(extra, axis=1).reset_index()
+    else:
+        extra = None
+
+    return mu.reset_index(), extra, mu_all, df
+
+
+def _stream_plates(fnames, columns):
+    # one plate at a time
+    for fname in fnames:
+        logger.info(f'reading data from {fname}, one plate at a time')
+        try:
+            yield from iter_plates(fname, columns=columns)
+        except ValueError as e:
+            logger.error(f'{e}, cannot use --streaming')
+            sys.exit(1)
+
+
+def main():
+    options = get_options()
+
+    set_logging(options.v)
 
     groupby = ['plate', 'row', 'column', 'experiment',
                'strain', 'treatment', 'concentration']
+    columns = groupby + ['od600', 'time']
 
-    logger.info('computing growth rate for each well')
+    if options.plot:
+        fig = create_figure(figsize=(3.5, 3.5))
 
-	# calculate growth rate
-    mu = df.groupby(groupby
-                   ).apply(calc_growth_rate,
-                           time=f'{options.window}min').T
-    # keep a copy of mu across all
-    # windows for plotting
-    mu_all = mu.copy()
-    mu_all = mu_all.T.stack()
-    mu_all.name = 'grate'
-    mu_all = mu_all.reset_index()
-    #
-    # mu = mu.max()
-    mu = mu.apply(lambda x: x.dropna().sort_values().tail(options.top_mu).mean())
-    mu.name = 'grate'
-    mu = mu.reset_index()
+    if options.from_windows is not None:
+        logger.info(f'reading growth rate estimates from {options.from_windows}')
+        if options.summaries or options.model:
+            logger.warning('summaries and growth models need the readings, '
+                           'skipping them')
+        wells, mu_all = load_windows(options.from_windows)
+        mu = [top_growth_rate(mu_all, groupby, top=options.top_mu).reindex(
+              pd.MultiIndex.from_frame(wells[groupby])).reset_index()]
+        extra = [None]
+
+        if options.plot:
+            mu_all.groupby(groupby, observed=True).apply(plot_windows,
+                                                         outdir=options.plots_output,
+                                                         fmt=options.format,
+                                                         fig=fig)
+        windows = [mu_all]
+    else:
+        if options.streaming:
+            plates = _stream_plates(options.data, columns)
+        else:
+            plates = [read_tables(options.data, columns=columns)]
+
+        mu = []
+        extra = []
+        windows = []
+        for df in plates:
+            m, e, mu_all, df = grate_wells(df, groupby, options)
+            mu.append(m)
+            extra.append(e)
+            # only kept if requested
+            if options.windows_output is not None:
+                windows.append(mu_all)
+
+            if options.plot:
+                df.groupby(groupby, observed=True).apply(plot,
+                                                         params=mu_all.set_index(groupby),
+                                                         outdir=options.plots_output,
+                                                         fmt=options.format,
+                                                         fig=fig)
+        # release the last plate
+        plates = df = mu_all = None
+
+    if len(mu) == 0:
+        logger.error('no plates found in the input data')
+        sys.exit(1)
+
+    # categories may differ between plates
+    mu = compact(pd.concat(mu, ignore_index=True))
+    mu = mu.sort_values(groupby, kind='mergesort').reset_index(drop=True)
+    if mu.duplicated(groupby).any():
+        logger.error('some wells are split across input files, '
+                     'cannot use --streaming')
+        sys.exit(1)
+
+    if options.windows_output is not None:
+        logger.info(f'writing growth rate estimates to {options.windows_output}')
+        save_windows(options.windows_output, mu[groupby],
+                     compact(pd.concat(windows, ignore_index=True)))
+    del windows
 
     # ugly hacks to add useful info
     mu['drug'] = [False if x == 0
                   else True
                   for x in mu['concentration'].values]
-    mu['evolved'] = [x if x == 'ancestral'
+    mu['evolved'] = [x if x == options.reference
                      else 'evolved'
                      for x in mu['treatment'].values]
 
-    logger.info('computing growth rate delta w/r/t ancestral strain')
+    logger.info(f'computing growth rate delta w/r/t {options.reference} strain')
 
-    try:
-        # compute growth rate delta
-        delta = mu.groupby('strain').apply(grate_delta).reset_index(drop=True)
-    except Exception as e:
-        logger.warning(f'could not compute delta growth rate ({str(e)}), skipping')
-        delta = None
+    # compute growth rate delta
+    mu['delta'] = grate_delta(mu, reference=options.reference)
 
     # write output
-    if delta is not None:
-        mu = mu.set_index(groupby).join(
-                delta.set_index(groupby)['delta'], how='left').reset_index()
-    try:
-        mu = mu.drop(columns=['level_6'])
-    except:
-        pass
+    if extra[0] is not None:
+        extra = compact(pd.concat(extra, ignore_index=True))
+        mu = mu.set_index(groupby).join(extra.set_index(groupby),
+                                        how='left').reset_index()
 
     logger.info(f'writing output growth rates (and deltas) to {options.output}')
 
-    mu.to_csv(options.output, sep='\t', index=False)
-
-    if options.plot:
-        fig = create_figure(figsize=(3.5, 3.5))
-
-        df.groupby(groupby).apply(plot,
-                                  params=mu_all.set_index(groupby),
-                                  outdir=options.plots_output,
-                                  fmt=options.format,
-                                  fig=fig)
+    write_table(mu, options.output, fmt=options.table_format, index=False)
 
 
 if __name__ == "__main__":
     main()
-
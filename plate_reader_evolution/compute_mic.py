@@ -4,14 +4,14 @@
 import os
 import logging
 import argparse
-import numpy as np
 import pandas as pd
 import logging.handlers
 
 from .__init__ import __version__
-from .mic import compute_mic
-from .mic import fit_gompertz, fit_hill
+from .mic import MAXFEV, analyse_mic, mic_seeds
 from .plot import plot_mic, create_figure
+from .tables import FORMATS, read_tables, write_table
+from .parallel import map_jobs, group_chunks
 from .colorlog import ColorFormatter
 
 
@@ -38,13 +38,20 @@ def get_options():
 
     parser.add_argument('data',
                         nargs='+',
-                        help='Input reading from plate reader; '
+                        help='Input reading from plate reader '
+                             '(tsv, parquet or feather format); '
                              'should contain the following columns: '
                              '"strain", "treatment", '
                              '"concentration", "plate", "passage", '
                              '"experiment", "od600"')
     parser.add_argument('output',
-                        help='Output file (tsv format)')
+                        help='Output file (tsv, parquet or feather format)')
+    parser.add_argument('--table-format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the output table '
+                             '(default: from the file extension, '
+                             'tsv if unknown)')
     
     parser.add_argument('--minimum-od',
                         type=float,
@@ -77,6 +84,41 @@ def get_options():
                         action='store_true',
                         help='Skip curve fitting, only compute cMIC '
                              '(default: also compute "regular" MIC and IC50)')
+    parser.add_argument('--maxfev',
+                        type=int,
+                        default=MAXFEV,
+                        help='Maximum function evaluations for each '
+                             'curve fit (default: %(default)d)')
+    parser.add_argument('--fit-timeout',
+                        type=float,
+                        default=None,
+                        help='Maximum time for each curve fit, '
+                             'slower fits are reported as "timeout"; '
+                             'an opt-in safety net, as results then '
+                             'depend on the machine load; --maxfev '
+                             'already bounds each fit '
+                             '(seconds, default: no limit)')
+
+    parser.add_argument('--warm-start',
+                        default=False,
+                        action='store_true',
+                        help='Start each curve fit from the converged '
+                             'parameters of the previous curve of the same '
+                             'strain and treatment (e.g. the previous '
+                             'replicate or passage) '
+                             '(default: estimate them for each curve)')
+    parser.add_argument('--warm-start-from',
+                        default=None,
+                        help='Start the curve fits from the parameters '
+                             'in the output of a previous run, '
+                             'implies --warm-start '
+                             '(default: don\'t)')
+
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to analyse '
+                             'the curves (default: %(default)d)')
 
     parser.add_argument('--plot',
                         default=False,
@@ -104,6 +146,11 @@ def get_options():
     return parser.parse_args()
 
 
+def _analyse_mic(args):
+    df, groupby, kwargs = args
+    return analyse_mic(df, groupby, **kwargs)
+
+
 def plot(v, params, outdir, fmt, fig, normalise, threshold):
     name = '_'.join([str(x) for x in v.name])
     fname = os.path.join(outdir, f'{name}.{fmt}')
@@ -120,59 +167,57 @@ def main():
 
     set_logging(options.v)
 
-    df = []
-    for filename in options.data:
-        logger.info(f'reading data from {filename}')
-        df.append(pd.read_csv(filename, sep='\t'))
-    df = pd.concat(df)
-   
     if not options.stacked:
         groupby = ['experiment', 'plate', 'strain', 'treatment', 'passage', 'date']
     else:
         groupby = ['experiment', 'strain', 'treatment', 'passage', 'date']
 
-    if not options.skip_fitting:
-        # compute MICs
-        logger.info('computing MICs (curve fitting)')
-        mic = df.groupby(groupby).apply(fit_gompertz,
-                                        estimate=True,
-                                        sanity=options.minimum_od,
-                                        normalise=options.minimum_od,
-                                        )['mic'].to_frame()
-    # compute MICs (classical "eyeballing" method)
-    logger.info('computing MICs (eyeballing)')
-    cmic = df.groupby(groupby).apply(compute_mic,
-                                     threshold=options.od_threshold,
-                                     normalise=options.minimum_od,
-                                     )
-    cmic.name = 'cmic'
-    cmic = cmic.to_frame()
-    if not options.skip_fitting:
-        # fit hill function (IC50)
-        logger.info('computing IC50s')
-        params = df.groupby(groupby).apply(fit_hill,
-                                           estimate=True,
-                                           sanity=options.minimum_od,
-                                               normalise=options.minimum_od)
-        params = params.join(mic.join(cmic, how='outer'), how='outer')
-    else:
-        params = cmic
-        for x in ['a', 'b', 'c', 'd', 'mic']:
-            params[x] = np.nan
-
-    params.to_csv(options.output,
-                  sep='\t')
+    df = read_tables(options.data,
+                     columns=groupby + ['concentration', 'od600'])
+
+    logger.info('computing MICs and IC50s'
+                if not options.skip_fitting
+                else 'computing MICs (eyeballing)')
+    # all methods on each curve at once,
+    # a few chunks of curves per job to balance the load
+    kwargs = {'threshold': options.od_threshold,
+              'normalise': options.minimum_od,
+              'sanity': options.minimum_od,
+              'fitting': not options.skip_fitting,
+              'maxfev': options.maxfev,
+              'timeout': options.fit_timeout}
+    chunkby = groupby
+    if options.warm_start or options.warm_start_from is not None:
+        kwargs['warm_start'] = True
+        if options.warm_start_from is not None:
+            logger.info(f'reading initial parameters from {options.warm_start_from}')
+            kwargs['seeds'] = mic_seeds(read_tables([options.warm_start_from]))
+        # all curves of a strain and treatment in the same chunk
+        chunkby = ['strain', 'treatment']
+    n_chunks = 1 if options.jobs <= 1 else options.jobs * 4
+    params = map_jobs(_analyse_mic,
+                      [(x, groupby, kwargs)
+                       for x in group_chunks(df, chunkby, n_chunks)],
+                      jobs=options.jobs)
+    params = pd.concat(list(params))
+    if chunkby != groupby:
+        # back to the order of the curves
+        params = params.sort_index(kind='mergesort')
+    if options.skip_fitting:
+        params = params[['cmic', 'a', 'b', 'c', 'd', 'mic']]
+
+    write_table(params, options.output, fmt=options.table_format)
 
     if options.plot:
         fig = create_figure(figsize=(3.5, 3.5)) 
         
-        df.groupby(groupby).apply(plot,
-                                  params=params,
-                                  normalise=options.minimum_od,
-                                  threshold=options.od_threshold,
-                                  outdir=options.plots_output,
-                                  fmt=options.format,
-                                  fig=fig)
+        df.groupby(groupby, observed=True).apply(plot,
+                                                 params=params,
+                                                 normalise=options.minimum_od,
+                                                 threshold=options.od_threshold,
+                                                 outdir=options.plots_output,
+                                                 fmt=options.format,
+                                                 fig=fig)
 
 
 if __name__ == "__main__":
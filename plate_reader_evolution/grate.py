@@ -1,9 +1,13 @@
 # Copyright 2019 Marco Galardini
 
+import os
 import logging
 import numpy as np
 import pandas as pd
 from scipy import stats
+from scipy.signal import savgol_coeffs
+
+from .tables import compact
 
 
 logger = logging.getLogger('evol.grate')
@@ -24,11 +28,431 @@ def calc_growth_rate(v, time='60min'):
     return mu.set_index('time').T
 
 
-def grate_delta(v):
-    # experimental
-    anc = v[v['treatment'] == 'ancestral']['grate'].mean()
-    evolved = v[v['treatment'] != 'ancestral']
+def grate_delta(mu, reference='ancestral', by='strain', column='treatment'):
+    """Relative growth rate difference w/r/t a reference
+
+    For each `by` group, the mean growth rate of the reference wells
+    is broadcast back to the other wells
+
+    Args:
+        mu (pandas.DataFrame)
+            Growth rates, must contain the `by` and `column` columns
+            and `grate`
+        reference (str)
+            Value of `column` identifying the reference wells
+        by (str)
+            Column identifying the groups (e.g. strains)
+        column (str)
+            Column holding the reference
+
+    Returns:
+        delta (pandas.Series)
+            (grate - reference) / reference for each well,
+            missing for reference wells and for groups
+            without a reference
+    """
+    is_reference = (mu[column] == reference).values
+    anc = mu['grate'].where(is_reference).groupby(mu[by],
+                                                  observed=True).transform('mean')
+    delta = ((mu['grate'] - anc) / anc).where(~is_reference)
+    delta.name = 'delta'
+    return delta
+
+
+def _well_ids(df, groupby):
+    # rows with missing keys belong to no well (-1)
+    group = df.groupby(groupby, observed=True, sort=True).ngroup()
+    return group.fillna(-1).values.astype(np.int64)
+
+
+def _window_sum(x, start, group):
+    # per-well running sums, so that rounding errors
+    # do not accumulate across wells
+    p = pd.Series(x).groupby(group).cumsum().values
+    return p - p[start] + x[start]
+
+
+def rolling_growth_rate(df, groupby, window='60min', min_periods=5):
+    """Rolling growth rate for every well at once
+
+    Vectorised equivalent of calc_growth_rate applied to each well:
+    the slope of ln(OD) over time in each time-based window is computed
+    in closed form from running sums of t, y, t², ty
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            (hours) and `ln(od)`
+        groupby (list)
+            Columns identifying a well
+        window (str)
+            Time window, as a pandas offset (e.g. "60min")
+        min_periods (int)
+            Minimum number of points in a window
+
+    Returns:
+        mu_all (pandas.DataFrame)
+            Growth rate at the end of each window: `groupby` columns,
+            `time` (hours) and `grate`
+    """
+    group = _well_ids(df, groupby)
+    # times as in a timedelta index, to get the same window boundaries
+    t = pd.to_timedelta(df['time'].values, unit='h'
+                        ).astype('timedelta64[ns]').values.view(np.int64)
+    keep = group >= 0
+    order = np.lexsort((t, group))
+    order = order[keep[order]]
+    if order.shape[0] == 0:
+        return pd.DataFrame(columns=groupby + ['time', 'grate'])
+
+    group = group[order]
+    t = t[order]
+    y = df['ln(od)'].values[order]
+
+    # first point of each window (left-open, like pandas)
+    # complex numbers are compared lexicographically, hence (well, time)
+    key = group + 1j * t
+    start = np.searchsorted(key, group + 1j * (t - pd.Timedelta(window).value),
+                            side='right')
+    n = np.arange(t.shape[0]) - start + 1
+
+    # nanoseconds to hours
+    th = t / 1000 / 1000 / 1000 / 60 / 60
+    # relative to the start of each well
+    first = np.r_[0, np.flatnonzero(np.diff(group)) + 1]
+    th0 = th - np.repeat(th[first], np.diff(np.r_[first, t.shape[0]]))
+
+    # windows with missing values have no estimate
+    invalid = ~np.isfinite(y)
+    y = np.where(invalid, 0, y)
+
+    st = _window_sum(th0, start, group)
+    sy = _window_sum(y, start, group)
+    stt = _window_sum(th0 * th0, start, group)
+    sty = _window_sum(th0 * y, start, group)
+    bad = _window_sum(invalid.astype(np.int64), start, group)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sty - st * sy) / (n * stt - st * st)
+    slope[(n < min_periods) | (bad > 0) | ~np.isfinite(slope)] = np.nan
+
+    mu_all = df[groupby].iloc[order].reset_index(drop=True)
+    mu_all['time'] = th
+    mu_all['grate'] = slope
+
+    return mu_all[mu_all['grate'].notna()].reset_index(drop=True)
+
+
+def top_growth_rate(mu_all, groupby, top=4):
+    """Average of the highest growth rate estimates of each well
+
+    Args:
+        mu_all (pandas.DataFrame)
+            Output of rolling_growth_rate
+        groupby (list)
+            Columns identifying a well
+        top (int)
+            How many estimates to average
+
+    Returns:
+        mu (pandas.Series)
+            Growth rate of each well, indexed by the `groupby` columns
+    """
+    mu = mu_all.sort_values('grate').groupby(groupby, observed=True).tail(top)
+    mu = mu.groupby(groupby, observed=True, sort=True)['grate'].mean()
+    mu.name = 'grate'
+    return mu
+
+
+def derivative_growth_rate(df, groupby, window=7, order=2):
+    """Growth rate as the derivative of the smoothed ln(OD)
+
+    A Savitzky-Golay filter is applied to every well at once over the
+    (well, timepoint) matrix; its derivative at the centre of each
+    window is the growth rate. Windows with missing points or uneven
+    time steps give no estimate
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            (hours) and `ln(od)`
+        groupby (list)
+            Columns identifying a well
+        window (int)
+            Number of points of the filter (odd)
+        order (int)
+            Order of the fitted polynomial
+
+    Returns:
+        mu_all (pandas.DataFrame)
+            Growth rate at the centre of each window: `groupby` columns,
+            `time` (hours) and `grate`, as in rolling_growth_rate
+    """
+    wells, t, y = well_time_matrix(df, groupby, 'ln(od)')
+    if t.shape[1] < window:
+        return pd.DataFrame(columns=groupby + ['time', 'grate'])
+
+    tw = np.lib.stride_tricks.sliding_window_view(t, window, axis=1)
+    yw = np.lib.stride_tricks.sliding_window_view(y, window, axis=1)
+    # time step of each window
+    step = (tw[..., -1] - tw[..., 0]) / (window - 1)
+    even = np.abs(np.diff(tw, axis=-1) - step[..., None]).max(axis=-1) <= step * 1e-3
+
+    coeffs = savgol_coeffs(window, order, deriv=1, use='dot')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grate = (yw @ coeffs) / step
+    grate[~even | ~np.isfinite(grate)] = np.nan
+
+    well, position = np.nonzero(np.isfinite(grate))
+    mu_all = wells.to_frame(index=False).iloc[well].reset_index(drop=True)
+    mu_all['time'] = tw[well, position, window // 2]
+    mu_all['grate'] = grate[well, position]
+    return mu_all
+
+
+def well_time_matrix(df, groupby, column):
+    """Arrange the curves of all wells in a (well, timepoint) matrix
+
+    Each row holds the points of a well sorted by time; wells with
+    fewer points are padded with NaNs at the end
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            and `column`
+        groupby (list)
+            Columns identifying a well
+        column (str)
+            Values to arrange
+
+    Returns:
+        wells (pandas.Index)
+            Wells, in the order of the rows
+        t (numpy.array)
+            Times (n_wells, n_timepoints)
+        y (numpy.array)
+            Values (n_wells, n_timepoints)
+    """
+    wells = df.groupby(groupby, observed=True, sort=True).size().index
+    group = _well_ids(df, groupby)
+    time = df['time'].values.astype(float)
+    order = np.lexsort((time, group))
+    order = order[group[order] >= 0]
+
+    group = group[order]
+    counts = np.bincount(group, minlength=len(wells))
+    first = np.r_[0, np.cumsum(counts)[:-1]]
+    position = np.arange(group.shape[0]) - first[group]
+
+    t = np.full((len(wells), counts.max() if len(wells) else 0), np.nan)
+    y = np.full(t.shape, np.nan)
+    t[group, position] = time[order]
+    y[group, position] = df[column].values.astype(float)[order]
+
+    return wells, t, y
+
+
+def growth_summaries(df, groupby, threshold=0.3):
+    """Descriptors of the growth curve of each well
+
+    All descriptors are computed in a single pass over the
+    (well, timepoint) matrix
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            (hours) and `od600`
+        groupby (list)
+            Columns identifying a well
+        threshold (float)
+            OD600 used for the time to threshold
+
+    Returns:
+        summaries (pandas.DataFrame)
+            Indexed by the `groupby` columns, with the area under the
+            curve (`auc`, OD600 * hours), the highest OD600 (`max_od`)
+            and the time at which the threshold is first reached
+            (`threshold_time`, hours, linearly interpolated)
+    """
+    wells, t, y = well_time_matrix(df, groupby, 'od600')
+    valid = np.isfinite(t) & np.isfinite(y)
+    y = np.where(valid, y, np.nan)
+
+    # trapezoids between consecutive points
+    area = (t[:, 1:] - t[:, :-1]) * (y[:, 1:] + y[:, :-1]) / 2
+    auc = np.where(np.isfinite(area), area, 0).sum(axis=1)
+    auc[valid.sum(axis=1) < 2] = np.nan
+
+    max_od = np.where(valid, y, -np.inf).max(axis=1, initial=-np.inf)
+    max_od[~np.isfinite(max_od)] = np.nan
+
+    # first point above the threshold
+    above = valid & (y >= threshold)
+    first = above.argmax(axis=1)
+    rows = np.arange(t.shape[0])
+    reached = above[rows, first]
+    previous = np.maximum(first - 1, 0)
+    t1, y1 = t[rows, first], y[rows, first]
+    t0, y0 = t[rows, previous], y[rows, previous]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = t0 + (threshold - y0) * (t1 - t0) / (y1 - y0)
+    # already above at the first point, or a gap before the crossing
+    crossing = np.where((first == 0) | ~np.isfinite(crossing), t1, crossing)
+    crossing[~reached] = np.nan
+
+    return pd.DataFrame({'auc': auc,
+                         'max_od': max_od,
+                         'threshold_time': crossing},
+                        index=wells)
+
+
+def trim_wells(df, groupby, maximum_od=None, maximum_time=None):
+    """Truncate each growth curve at its first crossing of a bound
+
+    Unlike a global filter, points after the crossing are removed even
+    if the OD drops back below the bound, and points before it are kept
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            (hours) and `od600`
+        groupby (list)
+            Columns identifying a well
+        maximum_od (float or None)
+            Points from the first one at or above this OD600 are removed
+        maximum_time (float or None)
+            Points after this time (hours) are removed
+
+    Returns:
+        df (pandas.DataFrame)
+            Trimmed curves, without missing OD600 values
+    """
+    group = _well_ids(df, groupby)
+    time = df['time'].values
+    od = df['od600'].values
+    order = np.lexsort((time, group))
+    group_sorted = group[order]
+
+    beyond = np.zeros(order.shape[0], dtype=bool)
+    if maximum_od is not None:
+        beyond |= od[order] >= maximum_od
+    if maximum_time is not None:
+        beyond |= time[order] > maximum_time
+
+    # first crossing at or after the start of each well,
+    # if it comes before the start of the next one
+    start = np.searchsorted(group_sorted, group_sorted, side='left')
+    end = np.searchsorted(group_sorted, group_sorted, side='right')
+    crossings = np.r_[np.flatnonzero(beyond), order.shape[0]]
+    cut = np.minimum(crossings[np.searchsorted(crossings, start)], end)
+
+    keep = np.zeros(order.shape[0], dtype=bool)
+    keep[order] = np.arange(order.shape[0]) < cut
+    keep &= (group >= 0) & np.isfinite(od)
+    return df[keep]
+
+
+# strains used for blank wells, besides missing ones
+BLANKS = ['Media Control']
+
+
+def subtract_background(df, method='mean', by=('experiment', 'plate'),
+                        window=5):
+    """Subtract the OD600 of blank wells from each plate
+
+    Blank wells are those without a strain or with one of BLANKS;
+    their OD600 is reduced to a baseline for each plate and timepoint
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `by` columns, `strain`,
+            `time` and `od600`
+        method (str)
+            How to compute the baseline from the blanks at each timepoint:
+            "mean", "median" or "smooth" (a running median
+            of the per-timepoint medians)
+        by (iterable)
+            Columns identifying a plate
+        window (int)
+            Number of timepoints of the running median
+
+    Returns:
+        df (pandas.DataFrame)
+            Growth curves with corrected OD600; plates without blanks
+            are left untouched
+    """
+    by = list(by)
+    keys = by + ['time']
+    blank = df['strain'].isna() | df['strain'].isin(BLANKS)
+
+    blanks = df[blank].groupby(keys, observed=True, sort=True)['od600']
+    if method == 'mean':
+        baseline = blanks.mean()
+    else:
+        baseline = blanks.median()
+    if method == 'smooth':
+        baseline = baseline.groupby(level=by, observed=True,
+                                    group_keys=False).apply(
+                lambda x: x.rolling(window, center=True, min_periods=1).median())
+    baseline.name = 'baseline'
+
+    baseline = df.join(baseline, on=keys)['baseline']
+    missing = df.loc[baseline.isna() & df['od600'].notna(), by].drop_duplicates()
+    for values in missing.itertuples(index=False, name=None):
+        logger.warning(f'no blanks found for {values}, not subtracting background')
+
+    df['od600'] = df['od600'] - baseline.fillna(0).values
+    return df
+
+
+def save_windows(fname, wells, mu_all):
+    """Store the growth rate estimates of all windows
+
+    Well keys are stored once, each window only refers
+    to its well by position
+
+    Args:
+        fname (str)
+            Output file (npz format)
+        wells (pandas.DataFrame)
+            Keys of all wells, one per row
+        mu_all (pandas.DataFrame)
+            Output of rolling_growth_rate
+    """
+    columns = list(wells.columns)
+    well = pd.MultiIndex.from_frame(wells).get_indexer(
+            pd.MultiIndex.from_frame(mu_all[columns]))
+    arrays = {'columns': np.array(columns),
+              'well': well.astype(np.int32),
+              'time': mu_all['time'].values.astype(float),
+              'grate': mu_all['grate'].values.astype(float)}
+    for column in columns:
+        values = wells[column]
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            arrays[f'well_{column}'] = values.values
+        else:
+            arrays[f'well_{column}'] = values.astype(str).values.astype('U')
+
+    # write then move, so that readers never see partial files
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, fname)
+
 
-    evolved['delta'] = (evolved['grate'] - anc) / anc
+def load_windows(fname):
+    """Load growth rate estimates stored with save_windows
 
-    return evolved
+    Returns:
+        wells (pandas.DataFrame)
+            Keys of all wells
+        mu_all (pandas.DataFrame)
+            Growth rate estimates of all windows
+    """
+    with np.load(fname) as a:
+        columns = [str(x) for x in a['columns']]
+        wells = pd.DataFrame({x: a[f'well_{x}'] for x in columns})
+        mu_all = wells.iloc[a['well']].reset_index(drop=True)
+        mu_all['time'] = a['time']
+        mu_all['grate'] = a['grate']
+    return compact(wells), compact(mu_all)
@@ -0,0 +1,329 @@
+# Copyright 2019 Marco Galardini
+
+import logging
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+
+from .grate import well_time_matrix
+
+
+logger = logging.getLogger('evol.growth')
+
+
+def logistic(t, lag, mu, A):
+    """Logistic growth model
+    ref: doi:10.1128/aem.56.6.1875-1881.1990
+
+    Args:
+        t (numpy.array)
+            Time vector
+        lag (float)
+            Lag time
+        mu (float)
+            Maximum specific growth rate
+        A (float)
+            Asymptote, as ln(OD/OD0)
+
+    Returns:
+        y (numpy.array)
+            ln(OD/OD0)
+    """
+    u = 4 * mu / A * (lag - t) + 2
+    return A * expit(-u)
+
+
+def _logistic_jac(t, lag, mu, A):
+    u = 4 * mu / A * (lag - t) + 2
+    y = A * expit(-u)
+    dy = -y * expit(u)
+    return np.stack(np.broadcast_arrays(dy * 4 * mu / A,
+                                        dy * 4 * (lag - t) / A,
+                                        expit(-u) - dy * 4 * mu * (lag - t) / A ** 2),
+                    axis=-1)
+
+
+def gompertz(t, lag, mu, A):
+    """Modified Gompertz growth model
+    ref: doi:10.1128/aem.56.6.1875-1881.1990
+
+    Args:
+        t (numpy.array)
+            Time vector
+        lag (float)
+            Lag time
+        mu (float)
+            Maximum specific growth rate
+        A (float)
+            Asymptote, as ln(OD/OD0)
+
+    Returns:
+        y (numpy.array)
+            ln(OD/OD0)
+    """
+    u = np.clip(mu * np.e / A * (lag - t) + 1, -50, 50)
+    return A * np.exp(-np.exp(u))
+
+
+def _gompertz_jac(t, lag, mu, A):
+    u = np.clip(mu * np.e / A * (lag - t) + 1, -50, 50)
+    e = np.exp(-np.exp(u))
+    dy = -A * e * np.exp(u)
+    return np.stack(np.broadcast_arrays(dy * mu * np.e / A,
+                                        dy * np.e * (lag - t) / A,
+                                        e - dy * mu * np.e * (lag - t) / A ** 2),
+                    axis=-1)
+
+
+def _baranyi_terms(t, lag, mu):
+    # q = exp(-mu t) + exp(-h0) - exp(-mu t - h0), with h0 = mu lag
+    et = np.exp(-mu * t)
+    eh = np.exp(-mu * lag)
+    q = et + eh * (1 - et)
+    z = mu * t + np.log(q)
+    return et, eh, q, z
+
+
+def baranyi(t, lag, mu, A):
+    """Baranyi growth model
+    ref: doi:10.1016/0168-1605(94)90157-0
+
+    Args:
+        t (numpy.array)
+            Time vector
+        lag (float)
+            Lag time
+        mu (float)
+            Maximum specific growth rate
+        A (float)
+            Asymptote, as ln(OD/OD0)
+
+    Returns:
+        y (numpy.array)
+            ln(OD/OD0)
+    """
+    _, _, _, z = _baranyi_terms(t, lag, mu)
+    z = np.minimum(z, 700)
+    return z - np.log1p(np.expm1(z) * np.exp(-A))
+
+
+def _baranyi_jac(t, lag, mu, A):
+    et, eh, q, z = _baranyi_terms(t, lag, mu)
+    z = np.minimum(z, 700)
+    d = 1 + np.expm1(z) * np.exp(-A)
+    dz = 1 - np.exp(z - A) / d
+    dq_dmu = -t * et - lag * eh * (1 - et) + eh * t * et
+    dq_dlag = -mu * eh * (1 - et)
+    return np.stack(np.broadcast_arrays(dz * dq_dlag / q,
+                                        dz * (t + dq_dmu / q),
+                                        np.expm1(z) * np.exp(-A) / d),
+                    axis=-1)
+
+
+MODELS = {'logistic': (logistic, _logistic_jac),
+          'gompertz': (gompertz, _gompertz_jac),
+          'baranyi': (baranyi, _baranyi_jac)}
+
+
+def initial_guess(t, y, span=2):
+    """Data-driven starting values for the growth models
+
+    The growth rate is the steepest slope over `span` intervals,
+    the lag time where its tangent crosses the baseline and
+    the asymptote the highest value
+
+    Args:
+        t (numpy.array)
+            Times (n_wells, n_timepoints)
+        y (numpy.array)
+            ln(OD/OD0) (n_wells, n_timepoints)
+        span (int)
+            Number of intervals used to compute slopes
+
+    Returns:
+        p0 (numpy.array)
+            Lag, growth rate and asymptote of each well (n_wells, 3)
+    """
+    n = t.shape[0]
+    p0 = np.full((n, 3), np.nan)
+    if t.shape[1] <= span:
+        return p0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y[:, span:] - y[:, :-span]) / (t[:, span:] - t[:, :-span])
+    slope = np.where(np.isfinite(slope), slope, -np.inf)
+    best = slope.argmax(axis=1)
+    rows = np.arange(n)
+    mu = np.maximum(slope[rows, best], 0.01)
+
+    tm = (t[rows, best] + t[rows, best + span]) / 2
+    ym = (y[rows, best] + y[rows, best + span]) / 2
+    lag = np.clip(tm - ym / mu, 0, np.nanmax(np.where(np.isfinite(t), t, np.nan),
+                                             axis=1, initial=0))
+
+    A = np.maximum(np.nanmax(np.where(np.isfinite(y), y, -np.inf), axis=1), 0.1)
+
+    valid = np.isfinite(slope[rows, best])
+    p0[valid] = np.stack([lag, mu, A], axis=1)[valid]
+    return p0
+
+
+def _residuals(func, t, y, mask, p):
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        r = func(t, p[:, [0]], p[:, [1]], p[:, [2]]) - y
+    return np.where(mask, r, 0)
+
+
+def fit_models(t, y, model, p0=None, max_iter=200, tol=1e-10,
+               min_range=0.1):
+    """Fit a growth model to many curves at once
+
+    Levenberg-Marquardt iterations are run on all curves together,
+    each with its own damping factor; curves stop iterating
+    once they have converged
+
+    Args:
+        t (numpy.array)
+            Times (n_wells, n_timepoints), NaN for missing points
+        y (numpy.array)
+            ln(OD/OD0) (n_wells, n_timepoints), NaN for missing points
+        model (str)
+            One of "logistic", "gompertz", "baranyi"
+        p0 (numpy.array or None)
+            Starting values (n_wells, 3); if None they are
+            estimated from the data
+        max_iter (int)
+            Maximum iterations
+        tol (float)
+            Relative decrease in the sum of squares below which
+            a curve is considered converged
+        min_range (float)
+            Curves whose ln(OD/OD0) range is smaller than this
+            (i.e. no growth) are not fitted
+
+    Returns:
+        p (numpy.array)
+            Lag, growth rate and asymptote of each well (n_wells, 3);
+            NaN when the fit failed
+    """
+    func, jac = MODELS[model]
+
+    mask = np.isfinite(t) & np.isfinite(y)
+    t = np.where(mask, t, 0)
+    y = np.where(mask, y, 0)
+    if p0 is None:
+        p0 = initial_guess(np.where(mask, t, np.nan),
+                           np.where(mask, y, np.nan))
+    p = p0.copy()
+
+    r = _residuals(func, t, y, mask, p)
+    cost = (r ** 2).sum(axis=1)
+    damping = np.full(p.shape[0], 1e-3)
+    # flat curves (blanks, inhibited wells) converge to nonsense
+    y_range = (np.where(mask, y, -np.inf).max(axis=1, initial=-np.inf) -
+               np.where(mask, y, np.inf).min(axis=1, initial=np.inf))
+    active = (mask.sum(axis=1) >= 5) & np.isfinite(p).all(axis=1) & np.isfinite(cost)
+    active &= y_range >= min_range
+    p[~active] = np.nan
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.shape[0] == 0:
+            break
+        pi = p[idx]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            J = jac(t[idx], pi[:, [0]], pi[:, [1]], pi[:, [2]])
+        J = np.where(mask[idx][..., None], J, 0)
+        JtJ = np.einsum('kmi,kmj->kij', J, J)
+        g = np.einsum('kmi,km->ki', J, r[idx])
+
+        diag = np.einsum('kii->ki', JtJ)
+        A = JtJ + (damping[idx, None] * diag)[..., None] * np.eye(3)
+        A += np.eye(3) * 1e-12
+        ok = np.isfinite(A).all(axis=(1, 2)) & np.isfinite(g).all(axis=1)
+        step = np.zeros_like(pi)
+        if ok.any():
+            step[ok] = _solve(A[ok], -g[ok])
+
+        new = pi + step
+        rn = _residuals(func, t[idx], y[idx], mask[idx], new)
+        cn = (rn ** 2).sum(axis=1)
+        better = ok & np.isfinite(cn) & (cn <= cost[idx])
+
+        improvement = (cost[idx] - cn) / np.maximum(cost[idx], 1e-300)
+        p[idx[better]] = new[better]
+        r[idx[better]] = rn[better]
+        cost[idx[better]] = cn[better]
+        damping[idx] = np.where(better, damping[idx] / 10, damping[idx] * 10)
+
+        done = (better & (improvement < tol)) | (damping[idx] > 1e10) | ~ok
+        active[idx[done]] = False
+
+    if active.any():
+        logger.debug(f'{model} fit did not converge for {active.sum()} curves')
+
+    # non-physical solutions
+    bad = (~np.isfinite(p).all(axis=1) | (p[:, 0] < 0) |
+           (p[:, 1] <= 0) | (p[:, 2] <= 0))
+    p[bad] = np.nan
+    return p
+
+
+def _solve(A, b):
+    # batched solve, one curve at a time if some are singular
+    try:
+        return np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.stack([np.linalg.lstsq(a, x, rcond=None)[0]
+                         for a, x in zip(A, b)])
+
+
+def fit_growth(df, groupby, models, baseline=3):
+    """Fit parametric growth models to every well
+
+    Models are fitted to ln(OD/OD0), where OD0 is the mean of the
+    first points of each well
+
+    Args:
+        df (pandas.DataFrame)
+            Growth curves, must contain the `groupby` columns, `time`
+            (hours) and `od600`
+        groupby (list)
+            Columns identifying a well
+        models (iterable)
+            Models to fit (see MODELS)
+        baseline (int)
+            Number of points used to estimate OD0
+
+    Returns:
+        params (pandas.DataFrame)
+            Indexed by the `groupby` columns, with lag time (hours),
+            maximum specific growth rate (1/hours) and carrying
+            capacity (OD600) of each model, as `{model}_lag`,
+            `{model}_mu` and `{model}_capacity`; the capacity is missing
+            when it exceeds ten times the highest OD600 of the well
+    """
+    wells, t, od = well_time_matrix(df, groupby, 'od600')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(od)
+    y[~np.isfinite(y)] = np.nan
+
+    first = y[:, :baseline]
+    n = np.isfinite(first).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y0 = np.where(np.isfinite(first), first, 0).sum(axis=1) / n
+    y = y - y0[:, None]
+
+    ymax = np.where(np.isfinite(y), y, -np.inf).max(axis=1, initial=-np.inf)
+
+    params = pd.DataFrame(index=wells)
+    for model in models:
+        logger.debug(f'fitting the {model} model to {len(wells)} wells')
+        p = fit_models(t, y, model)
+        params[f'{model}_lag'] = p[:, 0]
+        params[f'{model}_mu'] = p[:, 1]
+        # curves that have not reached a plateau
+        # give an unbounded asymptote
+        capacity = np.where(p[:, 2] > ymax + np.log(10), np.nan, p[:, 2])
+        params[f'{model}_capacity'] = np.exp(y0 + capacity)
+    return params
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+
+import os
+import logging
+import pandas as pd
+
+
+logger = logging.getLogger('evol.manifest')
+
+
+def manifest_fname(output):
+    return f'{output}.manifest'
+
+
+def _blocks(df, keys, **kwargs):
+    '''Serialise a sorted table one block of rows per key
+
+    Yields (key, bytes) tuples in the table's order
+    '''
+    for key, block in df.groupby(keys, sort=False, observed=True):
+        yield key, block.to_csv(sep='\t', header=False, **kwargs).encode()
+
+
+def _header(df, **kwargs):
+    return df.iloc[:0].to_csv(sep='\t', **kwargs).encode()
+
+
+def _write_manifest(output, keys, entries):
+    m = pd.DataFrame(entries, columns=keys + ['start', 'end'])
+    m.to_csv(manifest_fname(output), sep='\t', index=False)
+
+
+def read_manifest(output, keys):
+    '''Read the manifest of an output table
+
+    Returns a DataFrame with one row per block of the table,
+    with the key columns (as strings) and the byte offsets of the block,
+    or None if the table has no manifest
+    '''
+    fname = manifest_fname(output)
+    if not os.path.exists(fname) or not os.path.exists(output):
+        return None
+    m = pd.read_csv(fname, sep='\t', dtype={k: str for k in keys})
+    return m
+
+
+def write_blocks(df, output, keys, **kwargs):
+    '''Write a sorted table as tsv, along with its manifest
+
+    The manifest records the byte range of the rows belonging to each
+    key, so that new blocks can later be merged in without parsing or
+    re-serialising the existing ones
+    '''
+    entries = []
+    with open(output, 'wb') as f:
+        f.write(_header(df, **kwargs))
+        for key, block in _blocks(df, keys, **kwargs):
+            start = f.tell()
+            f.write(block)
+            entries.append(list(key) + [start, f.tell()])
+    _write_manifest(output, keys, entries)
+
+
+def merge_blocks(df, output, keys, **kwargs):
+    '''Merge new rows into a table written with write_blocks
+
+    Both the existing table and the new rows must be sorted by keys;
+    existing blocks are copied verbatim and the new ones are inserted
+    at their sorted position
+    '''
+    m = read_manifest(output, keys)
+    header = _header(df, **kwargs)
+
+    with open(output, 'rb') as f:
+        old_header = f.readline()
+    if old_header != header:
+        raise ValueError(f'the columns of {output} differ from the new data; '
+                         'cannot merge them')
+
+    # cast the manifest keys so that they sort like the table
+    for k in keys:
+        dtype = df[k].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtype = dtype.categories.dtype
+        m[k] = m[k].astype(dtype)
+
+    new = dict(_blocks(df, keys, **kwargs))
+    order = pd.concat([m[keys].assign(block=range(m.shape[0]), new=False),
+                       pd.DataFrame(list(new.keys()), columns=keys
+                                    ).assign(block=range(len(new)), new=True)],
+                      ignore_index=True)
+    # stable sort, so that existing blocks keep their relative order
+    order = order.sort_values(keys, kind='mergesort')
+
+    new_blocks = list(new.values())
+    entries = []
+    tmp = f'{output}.{os.getpid()}.tmp'
+    with open(output, 'rb') as old, open(tmp, 'wb') as f:
+        f.write(header)
+        for values in order[keys + ['block', 'new']].itertuples(index=False,
+                                                                name=None):
+            key, block, is_new = values[:-2], values[-2], values[-1]
+            start = f.tell()
+            if is_new:
+                f.write(new_blocks[block])
+            else:
+                old.seek(m['start'].iloc[block])
+                f.write(old.read(m['end'].iloc[block] - m['start'].iloc[block]))
+            entries.append(list(key) + [start, f.tell()])
+    os.replace(tmp, output)
+    _write_manifest(output, keys, entries)
+
+    logger.debug(f'merged {len(new_blocks)} new blocks into {output}')
@@ -1,14 +1,33 @@
 # Copyright 2019 Marco Galardini
 
+import time
 import logging
+import warnings
 import numpy as np
 import pandas as pd
 from scipy import stats
-from scipy.optimize import curve_fit
+from scipy.special import expit
+from scipy.optimize import curve_fit, OptimizeWarning
 
 
 logger = logging.getLogger('evol.mic')
 
+HILL = ['a', 'b', 'c', 'd',
+        'SDa', 'SDb',
+        'SDc', 'SDd']
+GOMPERTZ = HILL + ['mic']
+# fitted Gompertz parameters, as output columns
+GOMPERTZ_PARAMS = ['gompertz_A', 'gompertz_B',
+                   'gompertz_C', 'gompertz_M']
+
+# maximum function evaluations for each fit
+MAXFEV = 1000
+# outcomes of a fit: fitted, not fitted (flat or odd curve),
+# estimate outside of the tested concentrations,
+# no convergence within the budget, out of time, fit error
+STATUSES = ['converged', 'discarded', 'out_of_range',
+            'maxfev', 'timeout', 'failed']
+
 
 def compute_mic(values, threshold=0.3, normalise=None):
     """Compute MIC
@@ -30,14 +49,29 @@ def compute_mic(values, threshold=0.3, normalise=None):
         mic (float)
             MIC estimate
     """
-    values = values[['od600', 'concentration']
-            ].groupby('concentration').mean().reset_index()
-    y = values['od600']
+    return _compute_mic(values['concentration'].values,
+                        values['od600'].values,
+                        threshold=threshold,
+                        normalise=normalise)
+
+
+def _compute_mic(concentration, od600, threshold=0.3, normalise=None):
+    # average of each concentration, sorted
+    known = ~np.isnan(concentration)
+    concentration, od600 = concentration[known], od600[known]
+    if concentration.shape[0] == 0:
+        return np.nan
+    x, inverse = np.unique(concentration, return_inverse=True)
+    valid = ~np.isnan(od600)
+    with np.errstate(invalid='ignore'):
+        y = (np.bincount(inverse, weights=np.where(valid, od600, 0),
+                         minlength=x.shape[0]) /
+             np.bincount(inverse, weights=valid, minlength=x.shape[0]))
     v = None
     # if no raw OD value is above the initial threshold
     # assume no growth at all concentration
     if y[y > threshold].shape[0] == 0:
-        return values['concentration'].min()
+        return x.min()
     if normalise is not None:
         # robust normalisation
         # use an average of all OD values
@@ -45,42 +79,183 @@ def compute_mic(values, threshold=0.3, normalise=None):
         ymin = y[y <= normalise]
         # also remove artifacts from very high
         # OD values
-        if y.max() > 0.5:
+        if np.nanmax(y) > 0.5:
             ymax = np.mean(y[y > 0.5])
         else:
-            ymax = y.max()
+            ymax = np.nanmax(y)
         if ymin.shape[0] == 0:
-            v = values['concentration'].max()
+            v = x.max()
         else:
             ymin = np.mean(ymin)
             y = (y - ymin) / (ymax - ymin)
-    values['normalized'] = y
     if v is None:
         # tentative MIC value
-        v = values[y < threshold]['concentration']
+        v = x[y < threshold]
         if v.shape[0] == 0:
-            v = values['concentration'].max()
+            v = x.max()
         else:
             v = v.min()
     # check that there are no values above threshold with higher conc.
-    w = values[y >= threshold]['concentration'].max()
+    w = x[y >= threshold]
+    w = w.max() if w.shape[0] > 0 else np.nan
     if w > v:
         # tolerate up to 1
         # wells below the threshold to call the cMIC
-        values = values.sort_values('concentration')
-        if values[(values['concentration'] < w) &
-                  (values['normalized'] < threshold)].groupby('concentration').count().shape[0] < 2:
-            v = values[(values['concentration'] > w) &
-                       (values['normalized'] < threshold)]['concentration'].min()
+        if ((x < w) & (y < threshold)).sum() < 2:
+            v = x[(x > w) & (y < threshold)]
+            v = v.min() if v.shape[0] > 0 else np.nan
         else:
             # if the higher point is a single one, assume it's a spurious plate reader misreading
             # if more than one we are officially confused and refuse to give a cMIC
-            if values[(values['concentration'] > v) &
-                      (values['normalized'] >= threshold)].groupby('concentration').count().shape[0] > 1:
+            if ((x > v) & (y >= threshold)).sum() > 1:
                 v = np.nan
     return v
 
 
+def _masked_mean(values, mask):
+    # row-wise mean of the masked values,
+    # NaN if there are none
+    total = np.where(mask, values, 0).sum(axis=1)
+    n = mask.sum(axis=1)
+    return np.divide(total, n, out=np.full(total.shape, np.nan),
+                     where=n > 0)
+
+
+def _first(values, mask):
+    # first masked value of each row, NaN if there are none
+    found = mask.any(axis=1)
+    return np.where(found, values[np.arange(values.shape[0]),
+                                  mask.argmax(axis=1)], np.nan)
+
+
+def _last(values, mask):
+    # last masked value of each row, NaN if there are none
+    found = mask.any(axis=1)
+    last = mask.shape[1] - 1 - mask[:, ::-1].argmax(axis=1)
+    return np.where(found, values[np.arange(values.shape[0]), last], np.nan)
+
+
+def compute_mic_batch(df, groupby, threshold=0.3, normalise=None):
+    """Compute the MIC of many curves at once
+
+    Same as compute_mic applied to each curve; the curves are arranged
+    in a dense (curve, concentration) matrix of average OD600 values,
+    so that normalisation, thresholding and the tolerance for a single
+    spurious reading are array operations
+
+    Args:
+        df (pandas.DataFrame)
+            MIC curves, must contain the `groupby` columns,
+            `concentration` and `od600`
+        groupby (list)
+            Columns identifying a curve
+        threshold (float)
+            OD values above the threshold
+            are considered growth
+        normalise (float or None)
+            Whether to normalise the data (i.e. bringing it to a 0-1 range).
+            The provided value is used to compute the minimum values to have
+            a more robust normalization (the mean of od600 below this
+            value is used)
+
+    Returns:
+        mic (pandas.Series)
+            MIC estimate of each curve, indexed by the `groupby` columns
+    """
+    curves = df.groupby(groupby, observed=True, sort=True).size().index
+    n = len(curves)
+    group = df.groupby(groupby, observed=True, sort=True).ngroup()
+    group = group.fillna(-1).values.astype(np.int64)
+    concentration = df['concentration'].values.astype(float)
+    od600 = df['od600'].values.astype(float)
+
+    # one cell for each concentration of each curve,
+    # in increasing order (the k-th concentration of a curve is in column k)
+    order = np.lexsort((concentration, group))
+    order = order[(group[order] >= 0) & ~np.isnan(concentration[order])]
+    g = group[order]
+    c = concentration[order]
+    y = od600[order]
+    new = np.r_[True, (g[1:] != g[:-1]) | (c[1:] != c[:-1])]
+    cell = np.cumsum(new) - 1
+    cell_curve = g[new]
+    position = np.arange(cell_curve.shape[0]) - np.searchsorted(cell_curve,
+                                                                cell_curve)
+    width = position.max() + 1 if position.shape[0] else 1
+
+    valid = ~np.isnan(y)
+    with np.errstate(invalid='ignore'):
+        means = (np.bincount(cell, weights=np.where(valid, y, 0)) /
+                 np.bincount(cell, weights=valid))
+
+    x = np.full((n, width), np.nan)
+    y = np.full((n, width), np.nan)
+    present = np.zeros((n, width), dtype=bool)
+    x[cell_curve, position] = c[new]
+    y[cell_curve, position] = means
+    present[cell_curve, position] = True
+
+    lowest = _first(x, present)
+    highest = _last(x, present)
+
+    # if no raw OD value is above the initial threshold
+    # assume no growth at all concentration
+    growth = (present & (y > threshold)).any(axis=1)
+
+    # curves whose MIC is already set
+    fixed = np.zeros(n, dtype=bool)
+    if normalise is not None:
+        # robust normalisation
+        # use an average of all OD values
+        # below a sensible OD threshold
+        low = present & (y <= normalise)
+        ymin = _masked_mean(y, low)
+        # also remove artifacts from very high
+        # OD values
+        ymax = np.where(present & ~np.isnan(y), y, -np.inf).max(axis=1)
+        ymax[np.isinf(ymax)] = np.nan
+        ymax = np.where(ymax > 0.5, _masked_mean(y, present & (y > 0.5)), ymax)
+        fixed = ~low.any(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.where(fixed[:, None], y,
+                         (y - ymin[:, None]) / (ymax - ymin)[:, None])
+
+    # tentative MIC value
+    below = present & (y < threshold)
+    v = np.where(fixed | ~below.any(axis=1), highest, _first(x, below))
+
+    # check that there are no values above threshold with higher conc.
+    above = present & (y >= threshold)
+    w = _last(x, above)
+    with np.errstate(invalid='ignore'):
+        check = w > v
+        # tolerate up to 1
+        # wells below the threshold to call the cMIC
+        tolerate = (below & (x < w[:, None])).sum(axis=1) < 2
+        after = _first(x, below & (x > w[:, None]))
+        # if more than one we are officially confused and refuse to give a cMIC
+        confused = (above & (x > v[:, None])).sum(axis=1) > 1
+    v = np.where(check & tolerate, after, v)
+    v = np.where(check & ~tolerate & confused, np.nan, v)
+
+    mic = np.where(growth, v, lowest)
+    return pd.Series(mic, index=curves, name='cmic')
+
+
+def _normalised(y, normalise=None):
+    # robust normalisation
+    # use an average of all OD values
+    # below a sensible OD threshold
+    # None if there are no such values
+    if normalise is None:
+        return y
+    ymin = y[y <= normalise]
+    if ymin.shape[0] == 0:
+        return None
+    ymin = np.mean(ymin)
+    return (y - ymin) / (y.max() - ymin)
+
+
 def hill_func(x, a, b, c, d):
     """Hill function
     commonly used to fit MIC curves
@@ -99,7 +274,73 @@ def hill_func(x, a, b, c, d):
     return a+(b-a)/(1+(x/c)**d)
 
 
-def fit_hill(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
+def _hill(x, a, b, c, d):
+    # same as hill_func, without overflows
+    return a + (b - a) * expit(-d * np.log(x / c))
+
+
+def _hill_jac(x, a, b, c, d):
+    s = expit(-d * np.log(x / c))
+    ds = s * (1 - s)
+    return np.stack([1 - s,
+                     s,
+                     (b - a) * d / c * ds,
+                     -(b - a) * np.log(x / c) * ds], axis=1)
+
+
+def _deadline(func, timeout):
+    # abort the fit once the time is up
+    if timeout is None:
+        return func
+    deadline = time.monotonic() + timeout
+
+    def f(*args):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'fit timed out after {timeout} seconds')
+        return func(*args)
+    return f
+
+
+def _best_start(func, x, y, starts, lower, upper):
+    # initial parameters closest to the data
+    starts = [np.clip(p, lower, upper) for p in starts if p is not None]
+    if len(starts) == 0:
+        return None
+    with np.errstate(all='ignore'):
+        cost = [np.nansum((func(x, *p) - y)**2) for p in starts]
+    return starts[int(np.argmin(cost))]
+
+
+def _curve_fit(func, jac, x, y, p0, lower, upper, maxfev, timeout):
+    # bounded fit, returns parameters, standard deviations and status
+    p0 = np.clip(np.ones(len(lower)) if p0 is None else p0, lower, upper)
+    start = time.monotonic()
+    try:
+        with warnings.catch_warnings():
+            # covariance warnings, we report the status instead
+            warnings.simplefilter('ignore', OptimizeWarning)
+            params, pcov = curve_fit(_deadline(func, timeout),
+                                     x, y,
+                                     p0=p0,
+                                     jac=_deadline(jac, timeout),
+                                     bounds=(lower, upper),
+                                     method='trf',
+                                     max_nfev=maxfev)
+        return list(params), list(np.sqrt(np.diag(pcov))), 'converged'
+    except RuntimeError as e:
+        logger.warning(str(e))
+        if timeout is not None and time.monotonic() - start > timeout:
+            status = 'timeout'
+        else:
+            status = 'maxfev'
+    except ValueError as e:
+        logger.warning(str(e))
+        status = 'failed'
+    return [np.nan] * len(lower), [np.nan] * len(lower), status
+
+
+def fit_hill(v, estimate=True, sanity=None, normalise=None, maxfev=MAXFEV,
+             timeout=None):
     """Fit the Hill function to a MIC curve
 
     Args:
@@ -120,37 +361,43 @@ def fit_hill(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
             a more robust normalization (the mean of od600 below this
             value is used)
         maxfev (int)
-            Maximum iterations for curve fitting
+            Maximum function evaluations for curve fitting
+        timeout (float or None)
+            Maximum time for curve fitting (seconds)
 
     Returns:
         out (pd.Series)
-            Fitted curve parameters and standard deviations
+            Fitted curve parameters and standard deviations,
+            and status of the fit (see STATUSES)
     """
-    index = ['a', 'b', 'c', 'd',
-             'SDa', 'SDb',
-             'SDc', 'SDd']
     v = v[v['concentration'] != 0]
     x = v['concentration'].values
     y = v['od600'].values
-    if normalise is not None:
-        # robust normalisation
-        # use an average of all OD values
-        # below a sensible OD threshold
-        ymin = y[y <= normalise]
-        if ymin.shape[0] == 0:
-            c = v['concentration'].max()
-            return pd.Series([np.nan, np.nan, c, np.nan,
-                              np.nan, np.nan, np.nan, np.nan],
-                             index=index)
-        ymin = np.mean(ymin)
-        y = (y - ymin) / (y.max() - ymin)
+    values, status = _fit_hill(x, _normalised(y, normalise),
+                               estimate=estimate,
+                               sanity=sanity,
+                               maxfev=maxfev,
+                               timeout=timeout)
+    return pd.Series(values + [status], index=HILL + ['status'])
+
+
+def _fit_hill(x, y, estimate=True, sanity=None, maxfev=MAXFEV, timeout=None,
+              p0=None):
+    # x: non-zero concentrations, y: (normalised) OD600,
+    # None if it could not be normalised; p0: initial parameters
+    # (e.g. from a previous fit), used instead of the estimate
+    # if closer to the data
+    if y is None:
+        # no concentration other than zero
+        c = x.max() if x.shape[0] > 0 else np.nan
+        return [np.nan, np.nan, c, np.nan,
+                np.nan, np.nan, np.nan, np.nan], 'discarded'
+    guess = None
     if estimate:
-        p0 = [y.min(),
-              y.max(),
-              x.mean(),
-              1.0]
-    else:
-        p0 = None
+        guess = [y.min(),
+                 y.max(),
+                 x.mean(),
+                 1.0]
     if sanity is not None:
         discard = False
         if abs(y.max() - y.min()) <= sanity:
@@ -164,33 +411,20 @@ def fit_hill(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
                 c = x.min()
             else:
                 c = x.max()
-            return pd.Series([np.nan, np.nan, c, np.nan,
-                              np.nan, np.nan, np.nan, np.nan],
-                             index=index)
-    try:
-        params = curve_fit(hill_func,
-                           x, y,
-                           p0=p0,
-                           maxfev=maxfev)
-        [a, b, c, d] = params[0]
-        pcov = params[1]
-        [sda, sdb, sdc, sdd] = np.sqrt(np.diag(pcov))
-        if c > x.max():
-            return pd.Series([np.nan, np.nan, x.max(), np.nan,
-                              np.nan, np.nan, np.nan, np.nan],
-                             index=index)
-        return pd.Series([a, b, c, d, sda, sdb, sdc, sdd],
-                         index=index)
-    except RuntimeError as e:
-        logger.warning(str(e))
-        return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                          np.nan, np.nan, np.nan, np.nan],
-                         index=index)
-    except ValueError as e:
-        logger.warning(str(e))
-        return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                          np.nan, np.nan, np.nan, np.nan],
-                         index=index)
+            return [np.nan, np.nan, c, np.nan,
+                    np.nan, np.nan, np.nan, np.nan], 'discarded'
+    # asymptotes around the observed values, positive IC50
+    # around the tested range, increasing inhibition
+    span = max(y.max() - y.min(), 1e-3)
+    lower = [y.min() - span, y.min() - span, x.min() / 100, 0]
+    upper = [y.max() + span, y.max() + span, x.max() * 100, 50]
+    p0 = _best_start(_hill, x, y, [p0, guess], lower, upper)
+    params, sds, status = _curve_fit(_hill, _hill_jac, x, y, p0,
+                                     lower, upper, maxfev, timeout)
+    if status == 'converged' and params[2] > x.max():
+        return [np.nan, np.nan, x.max(), np.nan,
+                np.nan, np.nan, np.nan, np.nan], 'out_of_range'
+    return params + sds, status
 
 
 def mod_gompertz(x, A, B, C, M):
@@ -213,7 +447,22 @@ def mod_gompertz(x, A, B, C, M):
     return A + C * np.exp(-np.exp(B * (x - M)))
 
 
-def fit_gompertz(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
+def _gompertz(x, A, B, C, M):
+    # same as mod_gompertz, without overflows
+    return A + C * np.exp(-np.exp(np.minimum(B * (x - M), 700)))
+
+
+def _gompertz_jac(x, A, B, C, M):
+    e = np.exp(np.minimum(B * (x - M), 700))
+    g = np.exp(-e)
+    return np.stack([np.ones(x.shape[0]),
+                     -C * g * e * (x - M),
+                     g,
+                     C * g * e * B], axis=1)
+
+
+def fit_gompertz(v, estimate=True, sanity=None, normalise=None, maxfev=MAXFEV,
+                 timeout=None):
     """Fit the Gompertz function to a MIC curve
 
     Args:
@@ -234,41 +483,49 @@ def fit_gompertz(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
             a more robust normalization (the mean of od600 below this
             value is used)
         maxfev (int)
-            Maximum iterations for curve fitting
+            Maximum function evaluations for curve fitting
+        timeout (float or None)
+            Maximum time for curve fitting (seconds)
 
     Returns:
         out (pd.Series)
-            Fitted curve parameters and standard deviations
+            Fitted curve parameters and standard deviations,
+            and status of the fit (see STATUSES)
     """
-    index = ['a', 'b', 'c', 'd',
-             'SDa', 'SDb',
-             'SDc', 'SDd', 'mic']
     v = v[v['concentration'] != 0]
-    x = np.log10(v['concentration'].values)
+    concentration = v['concentration'].values
     y = v['od600'].values
-    if normalise is not None:
-        # robust normalisation
-        # use an average of all OD values
-        # below a sensible OD threshold
-        ymin = y[y <= normalise]
-        if ymin.shape[0] == 0:
-            mic = v['concentration'].max()
-            return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                              np.nan, np.nan, np.nan, np.nan,
-                              mic],
-                             index=index)
-        ymin = np.mean(ymin)
-        y = (y - ymin) / (y.max() - ymin)
+    values, status = _fit_gompertz(concentration, y,
+                                   _normalised(y, normalise),
+                                   estimate=estimate,
+                                   sanity=sanity,
+                                   maxfev=maxfev,
+                                   timeout=timeout)
+    return pd.Series(values + [status], index=GOMPERTZ + ['status'])
+
+
+def _fit_gompertz(concentration, od600, y, estimate=True, sanity=None,
+                  maxfev=MAXFEV, timeout=None, p0=None):
+    # concentration: non-zero concentrations, od600: raw OD600,
+    # y: (normalised) OD600, None if it could not be normalised;
+    # p0: initial parameters (e.g. from a previous fit), used
+    # instead of the estimate if closer to the data
+    x = np.log10(concentration)
+    if y is None:
+        # no concentration other than zero
+        mic = concentration.max() if concentration.shape[0] > 0 else np.nan
+        return [np.nan, np.nan, np.nan, np.nan,
+                np.nan, np.nan, np.nan, np.nan,
+                mic], 'discarded'
+    guess = None
     if estimate:
-        p0 = [y.min() / 10,
-              0.8,
-              1,
-              x.max() / 2]
-    else:
-        p0 = None
+        guess = [y.min() / 10,
+                 0.8,
+                 1,
+                 x.max() / 2]
     if sanity is not None:
         discard = False
-        yab = v['od600']
+        yab = od600
         if abs(yab.max() - yab.min()) <= sanity:
             discard = True
         if stats.spearmanr(x, y)[0] > 0.2:
@@ -277,37 +534,197 @@ def fit_gompertz(v, estimate=True, sanity=None, normalise=None, maxfev=999999):
             discard = True
         if discard:
             if y.mean() < 0.1:
-                mic = v[v['concentration'] != 0]['concentration'].min()
+                mic = concentration.min()
             else:
-                mic = v['concentration'].max()
-            return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                              np.nan, np.nan, np.nan, np.nan,
-                              mic],
-                             index=index)
-    try:
-        params = curve_fit(mod_gompertz,
-                           x, y,
-                           p0=p0,
-                           maxfev=maxfev)
-        [a, b, c, d] = params[0]
-        mic = 10**(d + 1/b)
-        pcov = params[1]
-        [sda, sdb, sdc, sdd] = np.sqrt(np.diag(pcov))
-        if mic > v['concentration'].max():
-            return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                              np.nan, np.nan, np.nan, np.nan,
-                              v['concentration'].max()],
-                             index=index)
-        if mic < v['concentration'].min():
-            return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                              np.nan, np.nan, np.nan, np.nan,
-                              v[v['concentration'] != 0]['concentration'].min()],
-                             index=index)
-        return pd.Series([a, b, c, d, sda, sdb, sdc, sdd, mic],
-                         index=index)
-    except RuntimeError as e:
-        logger.warning(str(e))
-        return pd.Series([np.nan, np.nan, np.nan, np.nan,
-                          np.nan, np.nan, np.nan, np.nan,
-                          np.nan],
-                         index=index)
+                mic = concentration.max()
+            return [np.nan, np.nan, np.nan, np.nan,
+                    np.nan, np.nan, np.nan, np.nan,
+                    mic], 'discarded'
+    # baseline around the observed values, positive slope and drop,
+    # inflection point around the tested range
+    span = max(y.max() - y.min(), 1e-3)
+    lower = [y.min() - span, 1e-3, 0, x.min() - 3]
+    upper = [y.max() + span, 100, 3 * span, x.max() + 3]
+    p0 = _best_start(_gompertz, x, y, [p0, guess], lower, upper)
+    params, sds, status = _curve_fit(_gompertz, _gompertz_jac, x, y, p0,
+                                     lower, upper, maxfev, timeout)
+    if status != 'converged':
+        return params + sds + [np.nan], status
+    [a, b, c, d] = params
+    mic = 10**(d + 1/b)
+    if mic > concentration.max():
+        return [np.nan, np.nan, np.nan, np.nan,
+                np.nan, np.nan, np.nan, np.nan,
+                concentration.max()], 'out_of_range'
+    if mic < concentration.min():
+        return [np.nan, np.nan, np.nan, np.nan,
+                np.nan, np.nan, np.nan, np.nan,
+                concentration.min()], 'out_of_range'
+    return params + sds + [mic], status
+
+
+def _curves(df, groupby):
+    # rows of each curve, in their original order
+    group = df.groupby(groupby, observed=True, sort=True).ngroup()
+    group = group.fillna(-1).values.astype(np.int64)
+    order = np.argsort(group, kind='stable')
+    order = order[group[order] >= 0]
+    bounds = np.searchsorted(group[order], np.arange(group.max() + 2))
+    return order, bounds
+
+
+def mic_seeds(params, by=('strain', 'treatment')):
+    """Initial parameters for warm-started fits, from a previous output
+
+    Args:
+        params (pandas.DataFrame)
+            Output of analyse_mic (or compute_mic), must contain the `by`
+            columns, the Hill parameters and the Gompertz parameters
+            (GOMPERTZ_PARAMS); the status columns are used if present
+        by (iterable)
+            Columns identifying curves fitted with the same parameters
+
+    Returns:
+        seeds (dict)
+            For each `by` key, the last converged Hill and Gompertz
+            parameters (None if there is none)
+    """
+    by = list(by)
+    params = params.reset_index()
+    seeds = {}
+    for model, columns in (('hill', ['a', 'b', 'c', 'd']),
+                           ('gompertz', GOMPERTZ_PARAMS)):
+        if not set(columns).issubset(params.columns):
+            logger.warning(f'no {model} parameters to warm-start from')
+            continue
+        converged = params[columns].notna().all(axis=1)
+        if f'{model}_status' in params.columns:
+            converged &= params[f'{model}_status'] == 'converged'
+        last = params[converged].groupby(by, observed=True,
+                                         sort=False)[columns].last()
+        for key, values in zip(last.index, last.values):
+            key = key if isinstance(key, tuple) else (key,)
+            seed = seeds.setdefault(key, [None, None])
+            seed[0 if model == 'hill' else 1] = list(values)
+    return seeds
+
+
+def _warm_fit(fit, p0, *args, **kwargs):
+    # warm-started fit, back to the estimated initial parameters
+    # if it did not converge (e.g. the curve has shifted too much)
+    if p0 is not None:
+        values, status = fit(*args, p0=p0, **kwargs)
+        if status in ('converged', 'discarded'):
+            return values, status
+    return fit(*args, **kwargs)
+
+
+def analyse_mic(df, groupby, threshold=0.3, normalise=None, sanity=None,
+                fitting=True, maxfev=MAXFEV, timeout=None, warm_start=False,
+                seeds=None, by=('strain', 'treatment')):
+    """MIC, cMIC and IC50 of all curves in a single pass
+
+    The classical MIC is computed for all curves at once
+    (compute_mic_batch); each curve is then extracted once and normalised
+    once, and the Gompertz MIC (fit_gompertz) and the Hill fit (fit_hill)
+    are computed from the same arrays.
+
+    With warm starts, curves are fitted in order and each fit starts from
+    the converged parameters of the previous curve with the same `by`
+    values (e.g. the previous replicate or passage of the same strain
+    and treatment), or from `seeds`
+
+    Args:
+        df (pandas.DataFrame)
+            MIC curves, must contain the `groupby` columns,
+            `concentration` and `od600`
+        groupby (list)
+            Columns identifying a curve
+        threshold (float)
+            OD values above the threshold are considered growth (cMIC)
+        normalise (float or None)
+            Minimum OD600 used for the robust normalisation
+        sanity (float or None)
+            Minimum delta(OD600) to fit the curves
+        fitting (bool)
+            Whether to fit the curves, or only compute the cMIC
+        maxfev (int)
+            Maximum function evaluations for each fit
+        timeout (float or None)
+            Maximum time for each fit (seconds)
+        warm_start (bool)
+            Whether to seed each fit with the previous converged fit
+        seeds (dict or None)
+            Initial seeds for the warm starts, as returned by mic_seeds
+        by (iterable)
+            Columns identifying curves sharing the warm starts,
+            must be part of `groupby`
+
+    Returns:
+        params (pandas.DataFrame)
+            Indexed by the `groupby` columns, with the Hill parameters
+            and their standard deviations, `mic` and `cmic`; if fitting,
+            also the Gompertz parameters (GOMPERTZ_PARAMS) and the status
+            of each fit (`hill_status`, `gompertz_status`)
+    """
+    curves = df.groupby(groupby, observed=True, sort=True).size().index
+    concentration = df['concentration'].values.astype(float)
+    od600 = df['od600'].values.astype(float)
+    order, bounds = _curves(df, groupby)
+
+    params = np.full((len(curves), len(HILL) + 2), np.nan)
+    params[:, -1] = compute_mic_batch(df, groupby,
+                                      threshold=threshold,
+                                      normalise=normalise).values
+    gompertz_params = np.full((len(curves), len(GOMPERTZ_PARAMS)), np.nan)
+    statuses = []
+    if fitting:
+        # key of each curve for the warm starts,
+        # converged fits replace the seeds as we go
+        keys = list(zip(*[curves.get_level_values(x) for x in by]))
+        seeds = {k: list(v) for k, v in (seeds or {}).items()}
+        warm = 0
+        for i in range(len(curves)):
+            rows = order[bounds[i]:bounds[i + 1]]
+            x = concentration[rows]
+            y = od600[rows]
+
+            nonzero = x != 0
+            x = x[nonzero]
+            y = y[nonzero]
+            yn = _normalised(y, normalise)
+            hill_p0, gompertz_p0 = seeds.get(keys[i], (None, None))
+            if not warm_start:
+                hill_p0, gompertz_p0 = None, None
+            elif hill_p0 is not None or gompertz_p0 is not None:
+                warm += 1
+            gompertz, gompertz_status = _warm_fit(_fit_gompertz, gompertz_p0,
+                                                  x, y, yn,
+                                                  sanity=sanity,
+                                                  maxfev=maxfev,
+                                                  timeout=timeout)
+            hill, hill_status = _warm_fit(_fit_hill, hill_p0,
+                                          x, yn,
+                                          sanity=sanity,
+                                          maxfev=maxfev,
+                                          timeout=timeout)
+            params[i, -2] = gompertz[-1]
+            params[i, :-2] = hill
+            gompertz_params[i] = gompertz[:4]
+            statuses.append((hill_status, gompertz_status))
+
+            seed = seeds.setdefault(keys[i], [None, None])
+            if hill_status == 'converged':
+                seed[0] = hill[:4]
+            if gompertz_status == 'converged':
+                seed[1] = gompertz[:4]
+        if warm_start:
+            logger.debug(f'{warm} out of {len(curves)} curves warm-started')
+
+    params = pd.DataFrame(params, index=curves,
+                          columns=HILL + ['mic', 'cmic'])
+    if fitting:
+        params[GOMPERTZ_PARAMS] = gompertz_params
+        params[['hill_status', 'gompertz_status']] = pd.DataFrame(
+                statuses, index=curves, dtype=object)
+    return params
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+
+import logging
+import multiprocessing
+import logging.handlers
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+logger = logging.getLogger('evol.parallel')
+
+
+def _init_worker(queue, level):
+    # send log records to the parent process
+    # instead of the handlers inherited from it
+    root = logging.getLogger('evol')
+    root.handlers = [logging.handlers.QueueHandler(queue)]
+    root.setLevel(level)
+    root.propagate = False
+
+
+def map_jobs(func, items, jobs=1, chunksize=1):
+    '''Apply a function to each item, using a pool of processes
+
+    Results are yielded in the same order as the items, regardless of
+    which worker finishes first. With a single job everything runs in
+    the current process. Messages logged by the workers are handled
+    by the "evol" logger of the current process.
+
+    Args:
+        func (callable)
+            Function to apply, must be picklable (i.e. defined at the
+            top level of a module)
+        items (iterable)
+            Arguments to the function
+        jobs (int)
+            Number of worker processes
+        chunksize (int)
+            How many items to send to a worker at once
+
+    Returns:
+        results (generator)
+    '''
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    logger.debug(f'starting a pool of {jobs} workers')
+    root = logging.getLogger('evol')
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(queue, *root.handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    executor = ProcessPoolExecutor(max_workers=jobs,
+                                   initializer=_init_worker,
+                                   initargs=(queue, root.getEffectiveLevel()))
+    try:
+        yield from executor.map(func, items, chunksize=chunksize)
+    finally:
+        # if the caller gave up early, queued items are cancelled, but
+        # running ones are still waited for, so that the workers have
+        # exited (and sent their last log records) before the listener stops
+        executor.shutdown(wait=True, cancel_futures=True)
+        listener.stop()
+
+
+def group_chunks(df, groupby, n):
+    '''Split a table in (at most) n chunks of whole groups
+
+    Chunks are yielded in the order of the groups, so that results
+    computed on each of them can be concatenated back in a
+    deterministic order; rows with missing keys are left out
+
+    Args:
+        df (pandas.DataFrame)
+            Table to split
+        groupby (list)
+            Columns identifying a group (e.g. a well)
+        n (int)
+            Number of chunks
+
+    Returns:
+        chunks (generator)
+            Generator of pandas.DataFrame
+    '''
+    group = df.groupby(groupby, observed=True, sort=True).ngroup()
+    group = group.fillna(-1).values.astype(np.int64)
+    n_groups = group.max() + 1 if group.shape[0] else 0
+    n = max(1, min(n, n_groups))
+    chunk = np.where(group >= 0, group * n // max(n_groups, 1), -1)
+    for i in range(n):
+        yield df[chunk == i]
@@ -1,28 +1,66 @@
 #!/usr/bin/env python
 
 
+import re
 import logging
+import operator
+import itertools
+import openpyxl
 import numpy as np
 import pandas as pd
 
 
 logger = logging.getLogger('evol.parse')
 
+# well names in the header of kinetic reads (e.g. "A1", "P24")
+WELL = re.compile(r'^[A-Z]{1,2}\d{1,2}$')
 
-def parse_excel(infile, p384=False):
-    '''Parse an excel output from the BioTek plate reader
 
-    The expecation is that the OD values are a single timepoint, from a 96-well
-    or 384-well microplate.
+def _iter_rows(infile):
+    '''Stream the rows of the first sheet of an excel file
 
-    More replicates are possible and their number is determined heuristically
-    '''
-    m = pd.read_excel(infile)
+    xlsx files are read in read-only mode, so that rows are decoded
+    one at a time; legacy xls files are loaded through pandas instead
 
-    # trim to the actual results area
-    n = m[m.columns[2]].dropna().iloc[1:]
+    Yields tuples of cell values, with empty cells as None
+    '''
+    if infile.endswith('xls'):
+        m = pd.read_excel(infile, header=None)
+        m = m.astype(object).where(m.notna(), None)
+        yield from m.itertuples(index=False, name=None)
+        return
+
+    wb = openpyxl.load_workbook(infile, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _parse_od_grid(rows, infile, p384=False):
+    # the first value in the third column is the header of the OD grid,
+    # the following ones are the actual readings
+    if not p384:
+        letters = 'ABCDEFGH'
+        n_columns = 12
+    else:
+        letters = 'ABCDEFGHIJKLMNOP'
+        n_columns = 24
+
+    grid = []
+    header = False
+    for row in rows:
+        value = row[2] if len(row) > 2 else None
+        if not header:
+            header = value is not None
+            continue
+        if value is None:
+            # the OD grid is complete
+            break
+        row = row[2:2 + n_columns]
+        grid.append(row + (None,) * (n_columns - len(row)))
 
-    n_values = n.shape[0]
+    n_values = len(grid)
 
     if not p384:
         # we assume a 96 well plate, so 8 rows
@@ -43,71 +81,217 @@ def parse_excel(infile, p384=False):
             raise ValueError(f'Could not parse {infile}; found {n_values} '
                               'measurements, not a multiple of 16')
 
+    if n_values == 0:
+        raise ValueError(f'Could not parse {infile}; no OD grid found')
+
     logger.debug(f'Found {repeats} from {infile}')
 
-    # get the meat of the spreadsheet
-    m = m.iloc[-n_values:, 2:-1]
+    # non-numeric readings (e.g. "OVRFLW") become NaN
+    od = pd.to_numeric(np.array(grid, dtype=object).ravel(),
+                       errors='coerce').astype(float)
+
+    # assign row and col names, row-major as in a stacked table
+    rows = np.repeat(np.array(list(letters)), repeats * n_columns)
+    columns = np.tile(np.arange(1, n_columns + 1), n_values)
+
+    # empty wells are not reported
+    keep = ~np.isnan(od)
+
+    index = pd.MultiIndex.from_arrays([rows[keep], columns[keep]],
+                                      names=['row', 'column'])
+
+    return pd.Series(od[keep], index=index, name='od600')
 
-    # assign row and col names
-    if not p384:
-        m.index = list(''.join([x * repeats for x in 'ABCDEFGH']))
-        m.columns = list(range(1, 13))
-    else:
-        m.index = list(''.join([x * repeats for x in 'ABCDEFGHIJKLMNOP']))
-        m.columns = list(range(1, 25))
 
-    m.index.name = 'row'
-    m.columns.name = 'column'
+def parse_excel(infile, p384=False):
+    '''Parse an excel output from the BioTek plate reader
 
-    m = m.stack()
-    m.name = 'od600'
+    The expecation is that the OD values are a single timepoint, from a 96-well
+    or 384-well microplate.
 
-    return m
+    More replicates are possible and their number is determined heuristically
+
+    The workbook is streamed row by row and reading stops as soon as the
+    OD grid is complete
+    '''
+    rows = _iter_rows(infile)
+    try:
+        return _parse_od_grid(rows, infile, p384=p384)
+    finally:
+        rows.close()
+
+
+def _elapsed_seconds(values):
+    '''Convert the elapsed time column of a kinetic read to seconds
+
+    Depending on how the cells are formatted the time is either a time of
+    day (first 24 hours), a timedelta, a datetime counting days from the
+    Excel epoch (past 24 hours), a fraction of days or a string version
+    of any of those; any number of days is supported
+    '''
+    s = pd.Series(values, dtype=object)
+
+    elapsed = pd.Series(np.nan, index=s.index)
+
+    # fractions of days
+    numeric = s.map(lambda x: isinstance(x, (int, float)))
+    elapsed[numeric] = s[numeric].astype(float) * 24 * 60 * 60
+
+    s = s[~numeric].astype(str).str.strip()
+    # datetimes, Excel counts 1900-01-01 as day one
+    dates = s.str.match(r'^\d{4}-\d{2}-\d{2}')
+    if dates.any():
+        elapsed[s[dates].index] = (pd.to_datetime(s[dates]) -
+                                   pd.Timestamp('1899-12-31')
+                                   ).dt.total_seconds()
+    # "HH:MM:SS", "1 day, HH:MM:SS", "2 days HH:MM:SS"...
+    times = s[~dates]
+    if times.shape[0] > 0:
+        elapsed[times.index] = pd.to_timedelta(
+                times.str.replace(',', '', regex=False)).dt.total_seconds()
+
+    return elapsed.round().astype(np.int64).values
+
+
+def _parse_time_series(rows, infile, chunk_size=256):
+    # the first row is the header: "Time", temperature and wells,
+    # the plate geometry is given by the wells that are present
+    header = next(rows)
+    time_column = header.index('Time')
+    wells = [(i, x) for i, x in enumerate(header)
+             if isinstance(x, str) and WELL.match(x)]
+    if len(wells) == 0:
+        raise ValueError(f'Could not parse {infile}; no wells found '
+                         'in the kinetic table header')
+    columns = [time_column] + [i for i, _ in wells]
+    get = operator.itemgetter(*columns)
+    width = max(columns) + 1
+
+    # only the needed columns are kept, in fixed-size blocks
+    times = []
+    chunks = []
+    chunk = np.empty((chunk_size, len(wells)))
+    i = 0
+    for row in rows:
+        if len(row) < width or row[time_column] is None:
+            if times:
+                # the kinetic table is complete
+                break
+            continue
+        values = get(row)
+        # incomplete timepoints are ignored
+        if any(x is None for x in values):
+            continue
+        try:
+            chunk[i] = values[1:]
+        except (TypeError, ValueError):
+            # non-numeric readings (e.g. "OVRFLW") become NaN
+            chunk[i] = pd.to_numeric(pd.Series(values[1:], dtype=object),
+                                     errors='coerce').values
+        times.append(values[0])
+        i += 1
+        if i == chunk_size:
+            chunks.append(chunk)
+            chunk = np.empty((chunk_size, len(wells)))
+            i = 0
+    chunks.append(chunk[:i])
+
+    od = np.concatenate(chunks)
+    time = _elapsed_seconds(times)
+    logger.debug(f'{infile} covers {time.max() / 60 / 60:.2f} hours '
+                 f'({od.shape[0]} timepoints, {od.shape[1]} wells)')
+
+    names = pd.Series([x for _, x in wells]).str.extract(r'^([A-Z]+)(\d+)$')
+    # one row per timepoint and well, timepoints first
+    row = np.tile(names[0].values, od.shape[0])
+    column = np.tile(names[1].astype(int).values, od.shape[0])
+    time = np.repeat(time, od.shape[1])
+    od = od.ravel()
+
+    keep = ~np.isnan(od)
+
+    index = pd.MultiIndex.from_arrays([row[keep], column[keep]],
+                                      names=['row', 'column'])
+
+    return pd.DataFrame({'time': time[keep],
+                         'od600': od[keep]},
+                        index=index)
 
 
 def parse_excel_time_series(infile):
     '''Parse an excel output from the BioTek plate reader
 
-    The expecation is that the OD values are multiple timepoints, from a 96-well
-    microplate.
+    The expecation is that the OD values are multiple timepoints, from a
+    microplate of any format (e.g. 96 or 384 wells), which is detected from
+    the wells listed in the header
+    '''
+    rows = _iter_rows(infile)
+    try:
+        # skip to the header of the kinetic table
+        return _parse_time_series(
+                itertools.dropwhile(lambda x: len(x) < 2 or x[1] != 'Time',
+                                    rows),
+                infile)
+    finally:
+        rows.close()
+
+
+def _is_grid_header(row):
+    # the OD grid header lists the column numbers, starting from 1
+    try:
+        return len(row) > 2 and int(row[2]) == 1
+    except (TypeError, ValueError):
+        return False
+
+
+def _check_geometry(infile, geometry, p384):
+    # a known plate format that differs from the requested one would be
+    # parsed into the wrong wells, anything else might be a partial read
+    expected = 384 if p384 else 96
+    if geometry == expected:
+        return
+    if geometry in (96, 384):
+        raise ValueError(f'{infile} is a {geometry}-well plate, but a '
+                         f'{expected}-well plate was requested')
+    logger.warning(f'{infile} looks like a {geometry}-well '
+                   'plate, which does not match the '
+                   'requested plate format')
+
+
+def parse_plate(infile, p384=False):
+    '''Parse an excel output from the BioTek plate reader
+
+    The header block is inspected once to tell an endpoint read from a
+    kinetic one, and the already opened sheet is handed over to the
+    relevant parser
+
+    Returns a tuple with the detected format ("endpoint" or "timeseries")
+    and the output of either parse_excel or parse_excel_time_series
     '''
-    m = pd.read_excel(infile, usecols='B:CU', parse_dates=False, date_parser=str)
-    n = m.dropna()
-    n = n.reset_index(drop=True)
-    n.columns = n.iloc[0]
-
-    n = n.iloc[1:].copy()
-
-    time = []
-    warning = True
-    for x in n['Time'].astype('str'):
-        if ' ' in x:
-            # 24 hours have elapsed
-            # extremely ugly hack
-            if warning:
-                logger.warning(f'{infile} went over 24 hours, applying ugly hack '
-                               'if the read went over 48 hours DO NOT trust the output')
-                warning = False
-            extra_seconds = 24 * 60 * 60
-            x = x.split()[-1]
-        else:
-            extra_seconds = 0
-        seconds = extra_seconds + int(x.split(':')[0]) * 60 * 60 + int(x.split(':')[1]) * 60 + int(x.split(':')[2])
-        time.append(seconds)
-    n['time'] = time
-
-    n = n.drop(columns=['Time', 'T° 600'])
-
-    n = n.set_index('time').stack()
-    n.name = 'od600'
-    n.index.names = ['time', 'well']
-    n = n.reset_index()
-    n['row'] = [x[0] for x in n['well'].values]
-    n['column'] = [int(x[1:]) for x in n['well'].values]
-
-    n = n.drop(columns=['well'])
-
-    return n.set_index(['row', 'column'])[['time', 'od600']]
+    rows = _iter_rows(infile)
+    try:
+        for row in rows:
+            if len(row) > 1 and row[1] == 'Time':
+                wells = [x for x in row[2:]
+                         if isinstance(x, str) and WELL.match(x)]
+                logger.debug(f'{infile} is a kinetic read '
+                             f'({len(wells)}-well plate)')
+                _check_geometry(infile, len(wells), p384)
+                return 'timeseries', _parse_time_series(
+                        itertools.chain([row], rows), infile)
+            if _is_grid_header(row):
+                n_columns = len([x for x in row[2:] if x is not None])
+                geometry = {12: 96, 24: 384}.get(n_columns, 'unknown')
+                logger.debug(f'{infile} is an endpoint read '
+                             f'({geometry}-well plate, {n_columns} columns)')
+                _check_geometry(infile, geometry, p384)
+                return 'endpoint', _parse_od_grid(
+                        itertools.chain([row], rows), infile, p384=p384)
+    finally:
+        rows.close()
+
+    raise ValueError(f'Could not parse {infile}; no OD grid or kinetic '
+                     'table found')
 
 
 def parse_plate_design(infile):
@@ -129,13 +313,12 @@ def parse_plate_design(infile):
         # ignore rows that don't have a value in the "Plate Well" column
         m = m[~m['Plate Well'].isna()].copy()
         #
-        m['row'] = [x[0] for x in m['Plate Well'].values]
-        m['column'] = [int(x[1:]) for x in m['Plate Well'].values]
+        m['row'] = m['Plate Well'].str[0]
+        m['column'] = m['Plate Well'].str[1:].astype(int)
 
         # "Description" actually refers to the strain
-        m['strain'] = [x if x != 'blank'
-                       else np.nan
-                       for x in m['Description'].values]
+        m['strain'] = m['Description'].where(m['Description'] != 'blank',
+                                             np.nan)
 
         # TODO: check for missing column
 
@@ -10,7 +10,11 @@ import pandas as pd
 import logging.handlers
 
 from .__init__ import __version__
-from .parse import parse_plate_design, parse_excel, parse_excel_time_series
+from .parse import parse_plate
+from .cache import default_cache_dir, cached_parse, cached_plate_design, evict
+from .manifest import read_manifest, write_blocks, merge_blocks
+from .tables import FORMATS, table_format, write_table, compact
+from .parallel import map_jobs
 from .colorlog import ColorFormatter
 
 
@@ -47,7 +51,7 @@ def get_options():
                              'EXP_PLATE_DATE')
     
     parser.add_argument('output',
-                        help='Output file (tsv format)')
+                        help='Output file (tsv, parquet or feather format)')
     
     etype = parser.add_mutually_exclusive_group()
     etype.add_argument('--mic',
@@ -62,8 +66,49 @@ def get_options():
     parser.add_argument('--p384',
                         action='store_true',
                         default=False,
-                        help='Experiment is done on 384 plates (default: 96 wells, '
-                             'would not work with time series data)')
+                        help='Experiment is done on 384 plates (default: 96 wells; '
+                             'the format of time series data is detected '
+                             'automatically)')
+
+    parser.add_argument('--table-format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the output table '
+                             '(default: from the file extension, '
+                             'tsv if unknown)')
+
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        default=False,
+                        help='Only parse files that are not already in '
+                             'the output file, and merge them into it '
+                             '(default: rebuild the output from scratch)')
+
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of files to parse in parallel '
+                             '(default: %(default)d)')
+
+    parser.add_argument('--cache-dir',
+                        default=default_cache_dir(),
+                        help='Directory used to cache parsed plates '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help='Do not use the parsed plates cache '
+                             '(default: use it)')
+    parser.add_argument('--cache-max-size',
+                        type=float,
+                        default=1024,
+                        help='Maximum size of the cache '
+                             '(MB, default: %(default).0f)')
+    parser.add_argument('--cache-max-age',
+                        type=float,
+                        default=90,
+                        help='Remove cached plates not used for this long '
+                             '(days, default: %(default).0f)')
 
     parser.add_argument('-v', action='count',
                         default=0,
@@ -74,6 +119,21 @@ def get_options():
     return parser.parse_args()
 
 
+def _parse_file(args):
+    # runs in the worker processes: errors are sent back
+    # to the main process, which knows how to report them
+    infile, cache_dir, p384 = args
+    try:
+        _, m = cached_parse(infile,
+                            ('endpoint', 'timeseries'),
+                            parse_plate,
+                            cache_dir=cache_dir,
+                            p384=p384)
+        return m, None
+    except Exception as e:
+        return None, e
+
+
 def main():
     options = get_options()
     folder = options.folder
@@ -81,12 +141,10 @@ def main():
 
     set_logging(options.v)
 
-    logger.info(f'reading plate design from {design}')
-    
-    d = {}
-    for name, exp, plate, df in parse_plate_design(design):
-        d[exp] = d.get(exp, {})
-        d[exp][plate] = df
+    if options.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = options.cache_dir
 
     # check if the folder is in the right format
     a_folder = os.path.basename(os.path.normpath(folder))
@@ -109,12 +167,39 @@ def main():
         logger.error('expecting "grate" in the folder name as experiment type'
                      f', found {etype}')
         sys.exit(1)
-    if exp not in d:
+
+    logger.info(f'reading plate design from {design}')
+
+    # only the plates of this experiment
+    d = {plate: df
+         for _, _, plate, df in cached_plate_design(design, cache_dir,
+                                                    experiment=exp)}
+
+    if len(d) == 0:
         logger.error(f'experiment {exp} not in the design table')
         sys.exit(1)
 
-    df = []
-    for infile in os.listdir(folder):
+    fmt = table_format(options.output, options.table_format)
+    if options.incremental and fmt != 'tsv':
+        logger.error('incremental mode is only available for tsv outputs')
+        sys.exit(1)
+
+    # blocks of rows in the output, one per plate reading
+    keys = ['plate', 'passage', 'date']
+    done = set()
+    manifest = None
+    if options.incremental:
+        manifest = read_manifest(options.output, keys)
+        if manifest is None:
+            logger.warning(f'no manifest found for {options.output}, '
+                           'rebuilding it from scratch')
+        else:
+            done = {tuple(x) for x in manifest[keys].values}
+            logger.info(f'found {len(done)} plate readings '
+                        f'already in {options.output}')
+
+    readings = []
+    for infile in sorted(os.listdir(folder)):
         if not infile.endswith('xlsx') and not infile.endswith('xls'):
             logger.debug(f'skipping {infile} from {folder}')
             continue
@@ -131,47 +216,70 @@ def main():
             # either "start" or TBD
             n_passage = passage
 
-        logger.info(f'about to parse {infile}')
+        if (plate, str(n_passage), date) in done:
+            logger.debug(f'skipping {infile}, already in {options.output}')
+            continue
+
+        readings.append((infile, plate, date, n_passage))
+
+    logger.info(f'about to parse {len(readings)} files '
+                f'using {options.jobs} jobs')
+
+    parsed = map_jobs(_parse_file,
+                      [(os.path.join(folder, infile), cache_dir, options.p384)
+                       for infile, _, _, _ in readings],
+                      jobs=options.jobs)
 
-        try:
-            m = parse_excel(os.path.join(folder, infile), p384=options.p384)
-        except Exception as e:
-            # probably a time series, try the alternative approach
-            logger.debug(f'could not parse {infile} from {folder} '
-                         'trying to see if it is a timeseries')
+    df = []
+    for (infile, plate, date, n_passage), (m, e) in zip(readings, parsed):
+        if e is not None:
+            logger.error(f'could not parse {infile} from {folder}')
             logger.debug(f'error: {e}')
-            try:
-                m = parse_excel_time_series(os.path.join(folder, infile))
-            except Exception as e:
-                logger.error(f'could not parse {infile} from {folder}')
-                logger.debug(f'error: {e}')
-                sys.exit(1)
+            sys.exit(1)
 
-        if plate not in d[exp]:
+        if plate not in d:
             logger.warning(f'plate {plate} from {exp} not in the design table')
             continue
 
         # join with design table
         if options.grate:
-            m = d[exp][plate].set_index(['row', 'column']).join(m, how='outer')
+            m = d[plate].set_index(['row', 'column']).join(m, how='outer')
         else:
-            m = d[exp][plate].set_index(['row', 'column']).join(m.to_frame(), how='outer')
+            m = d[plate].set_index(['row', 'column']).join(m.to_frame(), how='outer')
         m['plate'] = plate
         m['date'] = date
         m['passage'] = n_passage
-        df.append(m)
+        df.append(compact(m))
 
         logger.debug(f'parsed {infile}')
 
-    df = pd.concat(df)
+    if len(df) == 0 and manifest is not None:
+        logger.info(f'no new plate readings to add to {options.output}')
+    else:
+        df = pd.concat(df)
+
+        # add metadata
+        df['experiment'] = exp
+        df['type'] = etype.lower()
 
-    # add metadata
-    df['experiment'] = exp
-    df['type'] = etype.lower()
+        df = compact(df).sort_values(keys + ['row', 'column'])
 
-    df = df.sort_values(['plate', 'passage', 'date', 'row', 'column'])
+        if manifest is not None:
+            logger.info(f'merging new plate readings into {options.output}')
+            try:
+                merge_blocks(df, options.output, keys)
+            except ValueError as e:
+                logger.error(str(e))
+                sys.exit(1)
+        elif fmt == 'tsv':
+            write_blocks(df, options.output, keys)
+        else:
+            write_table(df, options.output, fmt=fmt)
 
-    df.to_csv(options.output, sep='\t')
+    if cache_dir is not None:
+        evict(cache_dir,
+              max_size=options.cache_max_size,
+              max_age=options.cache_max_age)
 
 
 if __name__ == "__main__":
@@ -10,8 +10,10 @@ import pandas as pd
 import logging.handlers
 
 from .__init__ import __version__
-from .parse import parse_ramp_design, parse_excel, parse_excel_time_series
+from .parse import parse_ramp_design, parse_plate
 from .parse import parse_shuffle_design
+from .cache import default_cache_dir, cached_parse, evict
+from .tables import FORMATS, write_table, compact
 from .colorlog import ColorFormatter
 
 
@@ -61,7 +63,7 @@ def get_options():
                              'must be present as a column in the design file')
 
     parser.add_argument('output',
-                        help='Output file (tsv format)')
+                        help='Output file (tsv, parquet or feather format)')
 
     parser.add_argument('--prefix',
                         default=None,
@@ -90,6 +92,13 @@ def get_options():
                              'concentration in the ramp '
                              '(default: %(default).2f)')
 
+    parser.add_argument('--table-format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the output table '
+                             '(default: from the file extension, '
+                             'tsv if unknown)')
+
     parser.add_argument('--shuffle-key',
                         default=None,
                         help='Randomization key file: '
@@ -103,8 +112,29 @@ def get_options():
     parser.add_argument('--p384',
                         action='store_true',
                         default=False,
-                        help='Experiment is done on 384 plates (default: 96 wells, '
-                             'would not work with time series data)')
+                        help='Experiment is done on 384 plates (default: 96 wells; '
+                             'the format of time series data is detected '
+                             'automatically)')
+
+    parser.add_argument('--cache-dir',
+                        default=default_cache_dir(),
+                        help='Directory used to cache parsed plates '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help='Do not use the parsed plates cache '
+                             '(default: use it)')
+    parser.add_argument('--cache-max-size',
+                        type=float,
+                        default=1024,
+                        help='Maximum size of the cache '
+                             '(MB, default: %(default).0f)')
+    parser.add_argument('--cache-max-age',
+                        type=float,
+                        default=90,
+                        help='Remove cached plates not used for this long '
+                             '(days, default: %(default).0f)')
 
     parser.add_argument('-v', action='count',
                         default=0,
@@ -128,6 +158,11 @@ def main():
 
     set_logging(options.v)
 
+    if options.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = options.cache_dir
+
     logger.info(f'reading plate design from {design}')
 
     de = parse_ramp_design(design, treatment, prefix=options.prefix)
@@ -168,16 +203,17 @@ def main():
             logger.info(f'about to parse {infile}')
 
             try:
-                m = parse_excel(os.path.join(folder, subfolder, infile), p384=options.p384)
-            except:
-                if options.p384:
-                    logger.error(f'could not parse {infile} from {subfolder}')
-                    sys.exit(1)
-
-                # probably a time series, try the alternative approach
-                logger.debug(f'could not parse {infile} from {subfolder} '
-                             'trying to see if it is a timeseries')
-                m = parse_excel_time_series(os.path.join(folder, subfolder, infile))
+                kind, m = cached_parse(os.path.join(folder, subfolder, infile),
+                                       ('endpoint', 'timeseries'),
+                                       parse_plate,
+                                       cache_dir=cache_dir,
+                                       p384=options.p384)
+            except Exception as e:
+                logger.error(f'could not parse {infile} from {subfolder}')
+                logger.debug(f'error: {e}')
+                sys.exit(1)
+
+            if kind == 'timeseries':
                 # pick last time point
                 m = m[m['time'] == m['time'].max()]['od600']
 
@@ -228,9 +264,14 @@ def main():
                            for rep, row, column, x in
                            df[['replicate', 'row', 'column', 'passage']].values]
 
-    df = df.sort_values(['passage', 'replicate', 'row', 'column'])
+    df = compact(df).sort_values(['passage', 'replicate', 'row', 'column'])
+
+    write_table(df, options.output, fmt=options.table_format, index=False)
 
-    df.to_csv(options.output, index=False, sep='\t')
+    if cache_dir is not None:
+        evict(cache_dir,
+              max_size=options.cache_max_size,
+              max_age=options.cache_max_age)
 
 
 if __name__ == "__main__":
@@ -245,16 +245,19 @@ def plot_growth_rate(df, params, fname, fig=None, name=''):
     else:
         plt.clf()
 
-    plt.plot(df['time'],
-             df['od600'],
-             'k.')
-
-    plt.ylabel('od600')
     plt.xlabel('time\n(hours)')
 
     plt.title(name)
 
-    plt.twinx()
+    # growth rate only if the curve is not available
+    if df is not None:
+        plt.plot(df['time'],
+                 df['od600'],
+                 'k.')
+
+        plt.ylabel('od600')
+
+        plt.twinx()
    
     plt.plot(params['time'],
              params['grate'],
@@ -10,6 +10,7 @@ import logging.handlers
 
 from .__init__ import __version__
 from .plot import make_color_dict, plot_legend, plot_passages, plot_appearance
+from .tables import read_tables
 from .colorlog import ColorFormatter
 
 
@@ -36,7 +37,8 @@ def get_options():
 
     parser.add_argument('data',
                         nargs='+',
-                        help='Input reading from plate reader; '
+                        help='Input reading from plate reader '
+                             '(tsv, parquet or feather format); '
                              'should contain the following columns: '
                              '"row", "column", '
                              '"plate", "passage", "strain", "treatment", '
@@ -72,11 +74,10 @@ def main():
 
     set_logging(options.v)
 
-    df = []
-    for filename in options.data:
-        logger.info(f'reading data from {filename}')
-        df.append(pd.read_csv(filename, sep='\t'))
-    df = pd.concat(df)
+    df = read_tables(options.data,
+                     columns=['row', 'column', 'plate', 'passage',
+                              'strain', 'treatment', 'concentration',
+                              'experiment', 'od600'])
 
     # make sure we don't group replicates together
     df['id'] = [f'{e}{p}{x}{y}'
@@ -106,7 +107,8 @@ def main():
 
     # pivot the tables
     op = df.pivot_table(index=['treatment-id', 'strain', 'id'],
-                        columns=['passage'], values='od600')
+                        columns=['passage'], values='od600',
+                        observed=True)
 
     logger.info(f'plotting all passages')
     fname = os.path.join(options.output, f'passages.{options.format}')
@@ -114,7 +116,8 @@ def main():
     
     # pivot the tables (average)
     op = df.pivot_table(index=['treatment-id', 'strain'],
-                        columns=['passage'], values='od600')
+                        columns=['passage'], values='od600',
+                        observed=True)
 
     logger.info(f'plotting all passages (average)')
     fname = os.path.join(options.output, f'passages_average.{options.format}')
@@ -142,16 +145,20 @@ def main():
             appearance.append(v)
         df['appearance'] = appearance
         app = df[df['appearance'] > 0].groupby([
-            'treatment-id', 'strain', 'id'])['passage'].min().reset_index()
+            'treatment-id', 'strain', 'id'],
+            observed=True)['passage'].min().reset_index()
         no_app = df[df['appearance'] == 0].groupby([
-            'treatment-id', 'strain', 'id'])['passage'].max().reset_index()
+            'treatment-id', 'strain', 'id'],
+            observed=True)['passage'].max().reset_index()
         no_app = no_app[no_app['passage'] == df['passage'].max()].copy()
         no_app['passage'] = df['passage'].max() + 1
         app = pd.concat([app, no_app])
-        app = app.groupby(['treatment-id', 'strain', 'id'])['passage'].min().reset_index()
+        app = app.groupby(['treatment-id', 'strain', 'id'],
+                          observed=True)['passage'].min().reset_index()
 
         df = df.pivot_table(index=['treatment-id', 'strain', 'id'],
-                            columns=['passage'], values='appearance')
+                            columns=['passage'], values='appearance',
+                            observed=True)
 
         logger.info(f'plotting first appearance (1)')
         fname = os.path.join(options.output, f'appearance_1.{options.format}')
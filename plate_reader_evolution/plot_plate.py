@@ -5,11 +5,11 @@ import os
 import logging
 import argparse
 import numpy as np
-import pandas as pd
 import logging.handlers
 
 from .__init__ import __version__
 from .plot import plot_plate, create_figure
+from .tables import read_tables
 from .colorlog import ColorFormatter
 
 
@@ -36,7 +36,8 @@ def get_options():
 
     parser.add_argument('data',
                         nargs='+',
-                        help='Input reading from plate reader; '
+                        help='Input reading from plate reader '
+                             '(tsv, parquet or feather format); '
                              'should contain the following columns: '
                              '"row", "column", '
                              '"plate", "passage", "date",'
@@ -92,11 +93,9 @@ def main():
 
     fig = create_figure() 
 
-    df = []
-    for filename in options.data:
-        logger.info(f'reading data from {filename}')
-        df.append(pd.read_csv(filename, sep='\t'))
-    df = pd.concat(df)
+    df = read_tables(options.data,
+                     columns=['row', 'column', 'plate', 'passage', 'date',
+                              'experiment', 'od600'])
 
     if options.date_is_replicate:
         groupby = ['experiment', 'plate', 'passage', 'date']
@@ -105,11 +104,11 @@ def main():
     else:
         groupby = ['experiment', 'plate', 'passage', 'date']
 
-    df.groupby(groupby).apply(plot,
-                              outdir=options.output,
-                              fmt=options.format,
-                              fig=fig,
-                              p384=options.p384)
+    df.groupby(groupby, observed=True).apply(plot,
+                                             outdir=options.output,
+                                             fmt=options.format,
+                                             fig=fig,
+                                             p384=options.p384)
 
 if __name__ == "__main__":
     main()
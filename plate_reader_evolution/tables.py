@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger('evol.tables')
+
+FORMATS = ('tsv', 'parquet', 'feather')
+
+EXTENSIONS = {'.tsv': 'tsv',
+              '.txt': 'tsv',
+              '.parquet': 'parquet',
+              '.pq': 'parquet',
+              '.feather': 'feather',
+              '.arrow': 'feather'}
+
+# shared schema of the long-format plate tables
+# columns with few distinct values, repeated on every well and timepoint
+CATEGORICAL = ['row', 'strain', 'treatment', 'plate',
+               'experiment', 'type', 'date']
+# integer columns with a small range
+SMALL_INTEGERS = {'column': np.int16,
+                  'passage': np.int16}
+
+
+def table_format(fname, fmt=None):
+    '''Guess the format of a table
+
+    An explicit format wins, then the file extension is used;
+    existing files with an unknown extension are recognised
+    by their magic bytes. Defaults to tsv
+    '''
+    if fmt is not None:
+        return fmt
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in EXTENSIONS:
+        return EXTENSIONS[ext]
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            magic = f.read(6)
+        if magic[:4] == b'PAR1':
+            return 'parquet'
+        if magic == b'ARROW1':
+            return 'feather'
+    return 'tsv'
+
+
+def _columnar_names(fname, fmt):
+    if fmt == 'parquet':
+        from pyarrow import parquet
+        return parquet.read_schema(fname).names
+    from pyarrow import ipc
+    with ipc.open_file(fname) as f:
+        return f.schema.names
+
+
+def compact(df):
+    '''Apply the shared schema to a long-format plate table
+
+    Repetitive columns become categoricals and small integers are
+    downcast; columns are converted in place and missing ones ignored.
+    Integer columns holding strings (e.g. a "start" passage) become
+    categoricals as well
+    '''
+    for column in CATEGORICAL:
+        if column in df.columns and df[column].dtype.name != 'category':
+            df[column] = df[column].astype('category')
+    for column, dtype in SMALL_INTEGERS.items():
+        if column not in df.columns:
+            continue
+        if pd.api.types.is_integer_dtype(df[column].dtype):
+            df[column] = df[column].astype(dtype)
+        elif not pd.api.types.is_numeric_dtype(df[column].dtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def read_table(fname, columns=None, fmt=None):
+    '''Read a table written by one of the CLIs
+
+    Args:
+        fname (str)
+            Input file
+        columns (iterable or None)
+            Load only these columns, if present (default: all)
+        fmt (str or None)
+            One of "tsv", "parquet", "feather"; if None it is guessed
+            from the file
+
+    Returns:
+        df (pandas.DataFrame)
+    '''
+    fmt = table_format(fname, fmt)
+    if fmt == 'tsv':
+        usecols = None
+        if columns is not None:
+            columns = set(columns)
+            usecols = lambda x: x in columns
+        df = pd.read_csv(fname, sep='\t', usecols=usecols)
+    else:
+        if columns is not None:
+            columns = [x for x in _columnar_names(fname, fmt)
+                       if x in set(columns)]
+        if fmt == 'parquet':
+            df = pd.read_parquet(fname, columns=columns)
+        else:
+            df = pd.read_feather(fname, columns=columns)
+    return compact(df)
+
+
+def iter_plates(fname, columns=None, fmt=None, chunksize=100000):
+    '''Read a table one plate at a time
+
+    Only a single plate is held in memory: tsv files are read in chunks,
+    and their rows must be grouped by plate (as written by parse_folder);
+    parquet and feather files are filtered on the "plate" column
+
+    Args:
+        fname (str)
+            Input file
+        columns (iterable or None)
+            Load only these columns, if present (default: all)
+        fmt (str or None)
+            One of "tsv", "parquet", "feather"; if None it is guessed
+            from the file
+        chunksize (int)
+            Number of rows read at once from tsv files
+
+    Returns a generator of pandas.DataFrame, one per plate
+    '''
+    fmt = table_format(fname, fmt)
+    if fmt == 'tsv':
+        yield from _iter_tsv_plates(fname, columns, chunksize)
+        return
+
+    if columns is not None:
+        columns = [x for x in _columnar_names(fname, fmt)
+                   if x in set(columns)]
+    if fmt == 'parquet':
+        plates = pd.read_parquet(fname, columns=['plate'])['plate']
+        for plate in pd.unique(plates.astype(str)):
+            yield compact(pd.read_parquet(fname, columns=columns,
+                                          filters=[('plate', '==', plate)]))
+    else:
+        from pyarrow import dataset
+        d = dataset.dataset(fname, format='ipc')
+        plates = pd.read_feather(fname, columns=['plate'])['plate']
+        for plate in pd.unique(plates.astype(str)):
+            t = d.to_table(columns=columns,
+                           filter=dataset.field('plate') == plate)
+            yield compact(t.to_pandas())
+
+
+def _iter_tsv_plates(fname, columns, chunksize):
+    usecols = None
+    if columns is not None:
+        columns = set(columns)
+        usecols = lambda x: x in columns
+
+    done = set()
+    plate = None
+    pending = []
+    for chunk in pd.read_csv(fname, sep='\t', usecols=usecols,
+                             chunksize=chunksize):
+        # runs of consecutive rows from the same plate
+        runs = (chunk['plate'] != chunk['plate'].shift()).cumsum()
+        for _, rows in chunk.groupby(runs, sort=False):
+            if rows['plate'].iloc[0] == plate:
+                pending.append(rows)
+                continue
+            if len(pending) > 0:
+                yield compact(pd.concat(pending, ignore_index=True))
+                done.add(plate)
+            plate = rows['plate'].iloc[0]
+            if plate in done:
+                raise ValueError(f'the rows of plate {plate} are not '
+                                 f'grouped together in {fname}')
+            pending = [rows]
+    if len(pending) > 0:
+        yield compact(pd.concat(pending, ignore_index=True))
+
+
+def read_tables(fnames, columns=None, fmt=None):
+    '''Read and concatenate several tables'''
+    df = []
+    for fname in fnames:
+        logger.info(f'reading data from {fname}')
+        df.append(read_table(fname, columns=columns, fmt=fmt))
+    df = pd.concat(df, ignore_index=True)
+    # categories may differ between files
+    return compact(df)
+
+
+def write_table(df, fname, fmt=None, index=True):
+    '''Write a table in tsv or columnar format
+
+    Args:
+        df (pandas.DataFrame)
+            Table to write
+        fname (str)
+            Output file
+        fmt (str or None)
+            One of "tsv", "parquet", "feather"; if None it is guessed
+            from the file extension
+        index (bool)
+            Whether to write the index as well
+
+    Columnar outputs follow the shared schema (see compact),
+    index levels included
+    '''
+    fmt = table_format(fname, fmt)
+    if fmt == 'tsv':
+        df.to_csv(fname, sep='\t', index=index)
+        return
+
+    if index:
+        df = df.reset_index()
+    else:
+        df = df.reset_index(drop=True)
+    # arrow needs a single type per column
+    for column in df.columns:
+        if pd.api.types.infer_dtype(df[column], skipna=True).startswith('mixed'):
+            df[column] = df[column].where(df[column].isna(),
+                                          df[column].astype(str))
+    # index levels (e.g. row and column) only become columns here
+    df = compact(df)
+    if fmt == 'parquet':
+        df.to_parquet(fname, index=False)
+    else:
+        df.to_feather(fname)
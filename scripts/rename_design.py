@@ -9,7 +9,7 @@ import numpy as np
 import pandas as pd
 import logging.handlers
 
-from plate_reader_evolution.parse import parse_plate_design
+from plate_reader_evolution.cache import default_cache_dir, cached_plate_design
 from plate_reader_evolution.colorlog import ColorFormatter
 
 
@@ -45,6 +45,16 @@ def get_options():
     parser.add_argument('output',
                         help='Output')
     
+    parser.add_argument('--cache-dir',
+                        default=default_cache_dir(),
+                        help='Directory used to cache the compiled plate design '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help='Do not use the compiled plate design cache '
+                             '(default: use it)')
+
     parser.add_argument('-v', action='count',
                         default=0,
                         help='Increase verbosity level')
@@ -60,10 +70,15 @@ if __name__ == "__main__":
 
     set_logging(options.v)
 
+    if options.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = options.cache_dir
+
     logger.info(f'reading plate design from {design}')
     
     d = []
-    for name, exp, plate, df in parse_plate_design(design):
+    for name, exp, plate, df in cached_plate_design(design, cache_dir):
         logger.info(f'reading design for {name}, {exp}, {plate}')
         df['experiment'] = exp
         df['plate'] = plate
@@ -60,6 +60,8 @@ setup(
                       'scipy',
                       'pandas',
                       'matplotlib',
-                      'seaborn',]
+                      'seaborn',
+                      'openpyxl',],
+    extras_require={'columnar': ['pyarrow']},
     #test_suite="tests",
 )